@@ -0,0 +1,263 @@
+import sys
+import time
+import logging
+import tracemalloc
+import subprocess
+import click
+import numpy as np
+from openslide import ImageSlide
+from openslide.deepzoom import DeepZoomGenerator
+from PIL import Image as PILImage
+sys.path.append('.')
+from src.classes import (
+    Dataset, TileSource, Collection, generate_patches, process, Coord,
+    CoordArray, Image, ID, Sample
+)
+from src.metadata import Metadata
+from src.aggregate import GroupBy
+
+logger = logging.getLogger(__name__)
+
+
+def synthetic_slide(size, seed=42):
+    """An in-memory slide of random tissue-coloured noise"""
+    rs = np.random.RandomState(seed)
+    pixels = rs.randint(100, 255, (size, size, 3)).astype(np.uint8)
+    return ImageSlide(PILImage.fromarray(pixels))
+
+
+def synthetic_coords(slide, s, n, seed=42):
+    rs = np.random.RandomState(seed)
+    limit = (np.array(slide.level_dimensions[-1]) - s) / \
+        slide.level_downsamples[-1]
+    return [
+        Coord(int(x), int(y)) for (x, y) in
+        zip(rs.randint(0, limit[0], n), rs.randint(0, limit[1], n))
+    ]
+
+
+def report(name, n, seconds):
+    print(f'{name:<24} {n / seconds:10.1f} patches/s ({seconds:.2f}s)')
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.option('--slide_size', default=8192, help="Synthetic slide size")
+@click.option('--patch_size', default=128, help="Patch size in pixels")
+@click.option('--n_patches', default=500, help="Number of patches to read")
+def patches(slide_size, patch_size, n_patches):
+    """Patches/second per tile, with a shared TileSource and batched"""
+    slide = synthetic_slide(slide_size)
+    coords = synthetic_coords(slide, patch_size, n_patches)
+    downsample = slide.level_downsamples[-1]
+
+    start = time.time()
+    patches_data = np.zeros(
+        (n_patches, patch_size, patch_size, 3), dtype=np.float16
+    )
+    for (i, coord) in enumerate(coords):
+        tile_generator = DeepZoomGenerator(
+            slide, tile_size=patch_size, overlap=0, limit_bounds=False
+        )
+        tile = tile_generator.get_tile(
+            tile_generator.level_count - 1, (
+                (downsample * coord.x) / patch_size,
+                (downsample * coord.y) / patch_size)
+        )
+        patches_data[i, :, :, :] = process(np.array(tile))
+    report('generator per patch', n_patches, time.time() - start)
+
+    start = time.time()
+    generate_patches(TileSource(slide), coords, patch_size)
+    report('shared TileSource', n_patches, time.time() - start)
+
+    start = time.time()
+    process(TileSource(slide).read_patches(
+        np.array([c.to_array() for c in coords]), patch_size
+    ))
+    report('batched read_region', n_patches, time.time() - start)
+
+
+@main.command()
+@click.option('--n_tissues', default=6, help="Number of tissues")
+@click.option('--n_images', default=10, help="Number of images per tissue")
+@click.option('--patch_size', default=128, help="Patch size in pixels")
+@click.option('--n_patches', default=100, help="Patches per image")
+@click.option('--batch_size', default=64, help="Training batch size")
+def memory(n_tissues, n_images, patch_size, n_patches, batch_size):
+    """Footprint of float patch buffers against uint8 patches"""
+    from src.callbacks import peak_rss
+    dataset = Dataset(n_tissues=n_tissues, n_images=n_images)
+    patches_data, imageIDs_data = dataset.sample_data(patch_size, n_patches)
+    N = len(patches_data)
+    print(f'{dataset} patch_size={patch_size} n_patches={n_patches} N={N}')
+
+    def float_buffer():
+        # The former sample_data: a float64 buffer of the whole patch set,
+        # filled image by image with float16 processed patches
+        buffer = np.zeros(patches_data.shape)
+        for i in range(0, N, n_patches):
+            buffer[i:i + n_patches] = process(patches_data[i:i + n_patches])
+        return buffer
+
+    def batches():
+        for i in range(0, N, batch_size):
+            process(patches_data[i:i + batch_size]).astype(np.float32)
+
+    # The uint8 path runs first, as peak RSS never goes back down
+    for (name, build) in (
+        ('uint8 store, float32 batches', batches),
+        ('float64 sample_data buffer', float_buffer),
+    ):
+        rss = peak_rss()
+        _, seconds, peak = measure(build)
+        print(
+            f'{name:<30} {seconds:8.2f}s {peak:10.1f}MB traced peak '
+            f'{peak_rss() - rss:10.1f}MB peak RSS growth'
+        )
+
+
+@main.command()
+@click.option('--repeats', default=5, help="Number of fresh interpreters")
+def startup(repeats):
+    """Import latency of src.classes and cost of first metadata access"""
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.run(
+            [sys.executable, '-c', 'import src.classes'], check=True
+        )
+        timings.append(time.time() - start)
+    print(f'{"import src.classes":<28} {np.median(timings):8.3f}s (median)')
+
+    start = time.time()
+    len(Collection.images_with_samples)
+    print(f'{"images_with_samples":<28} {time.time() - start:8.3f}s')
+    start = time.time()
+    len(Collection.samples)
+    print(f'{"Collection.samples":<28} {time.time() - start:8.3f}s')
+
+
+def unslotted(cls):
+    """Copy of a class without its __slots__, keeping a __dict__"""
+    namespace = {
+        k: v for (k, v) in vars(cls).items()
+        if k not in cls.__slots__ + ('__slots__',)
+    }
+    return type(cls.__name__, (), namespace)
+
+
+def measure(build):
+    """Run build, returning its result, seconds and traced peak MB"""
+    tracemalloc.start()
+    start = time.time()
+    result = build()
+    seconds = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def report_catalog(name, n, seconds, peak):
+    print(f'{name:<28} {n / seconds:12.0f} objects/s {peak:10.1f}MB')
+
+
+@main.command()
+@click.option('--grid_size', default=1000, help="Coordinate grid side")
+def catalog(grid_size):
+    """Memory and build rate of the catalog objects and coordinates"""
+    imageIDs = Metadata.imageIDs
+    samples = Metadata.samples
+    n = len(imageIDs)
+    print(f'{n} images, {len(samples)} samples')
+    for cls, build in [
+        (Image, lambda cls: [cls(x) for x in imageIDs]),
+        (ID, lambda cls: [cls(x) for x in imageIDs]),
+        (Sample, lambda cls: [
+            cls(row) for (_, row) in samples.iloc[:n].iterrows()
+        ]),
+    ]:
+        for name, variant in [
+            ('__slots__', cls), ('__dict__', unslotted(cls))
+        ]:
+            _, seconds, peak = measure(lambda: build(variant))
+            report_catalog(f'{cls.__name__} {name}', n, seconds, peak)
+
+    _, seconds, peak = measure(lambda: Sample.from_metadata(samples))
+    report_catalog('Sample.from_metadata', len(samples), seconds, peak)
+
+    xs, ys = np.meshgrid(
+        np.arange(grid_size), np.arange(grid_size), indexing='ij'
+    )
+    limit = Coord(grid_size // 2, grid_size // 2)
+    N = grid_size * grid_size
+    coords, seconds, peak = measure(lambda: [
+        Coord(int(x), int(y)) for (x, y) in zip(xs.ravel(), ys.ravel())
+    ])
+    report_catalog('Coord list', N, seconds, peak)
+    _, seconds, peak = measure(
+        lambda: [(c * 4.0) / 128 < limit for c in coords]
+    )
+    report_catalog('Coord list * / <', N, seconds, peak)
+    del coords
+    coords, seconds, peak = measure(
+        lambda: CoordArray(xs.ravel(), ys.ravel())
+    )
+    report_catalog('CoordArray', N, seconds, peak)
+    _, seconds, peak = measure(lambda: (coords * 4.0) / 128 < limit)
+    report_catalog('CoordArray * / <', N, seconds, peak)
+
+
+@main.command()
+@click.option('--n_rows', default=200000, help="Number of patch features")
+@click.option('--n_groups', default=1000, help="Number of groups")
+@click.option('--dim', default=64, help="Feature dimension")
+def aggregate(n_rows, n_groups, dim):
+    """Per-group aggregation with a mask per group against GroupBy"""
+    rs = np.random.RandomState(42)
+    features = rs.randn(n_rows, dim).astype(np.float32)
+    keys = rs.randint(0, n_groups, n_rows)
+
+    start = time.time()
+    for f in np.unique(keys):
+        f_idx = keys == f
+        np.mean(features[f_idx], 0)
+        np.median(features[f_idx], 0)
+    print(f'{"mask per group":<24} {time.time() - start:8.3f}s')
+
+    start = time.time()
+    GroupBy(keys).aggregate(features, ('mean', 'median'))
+    print(f'{"GroupBy":<24} {time.time() - start:8.3f}s')
+
+    start = time.time()
+    GroupBy(np.repeat(np.arange(n_groups), n_rows // n_groups)).aggregate(
+        features[:n_rows // n_groups * n_groups], ('mean', 'median')
+    )
+    print(f'{"GroupBy, equal groups":<24} {time.time() - start:8.3f}s')
+
+
+@main.command()
+@click.argument('model_name')
+def throughput(model_name):
+    """Per-epoch input wait and step time of a training run"""
+    from src.callbacks import throughput_report
+    epochs = throughput_report(
+        f'tensorboardlogs/{model_name}/throughput.csv'
+    )
+    print(epochs.to_string(float_format=lambda x: f'{x:.3f}'))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        filename='logs/benchmark.log',
+        level=logging.DEBUG,
+        format=(
+            "%(asctime)s | %(name)s | %(processName)s | "
+            "%(levelname)s: %(message)s"
+        )
+    )
+    main()
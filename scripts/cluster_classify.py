@@ -5,72 +5,69 @@ from openslide.deepzoom import DeepZoomGenerator
 import cv2
 import mahotas
 import click
-import pickle
 import scipy.misc
 import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
 from tqdm import tqdm
-from os.path import isfile
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import matplotlib.cm as cmx
 from collections import namedtuple
 from sklearn import metrics
-from sklearn.model_selection import train_test_split
-from sklearn.linear_model import LogisticRegression
-from sklearn.ensemble import RandomForestClassifier
 from sklearn.preprocessing import label_binarize
-from sklearn.svm import SVC
 from sklearn.multiclass import OneVsRestClassifier
-from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
-from keras.models import Model, load_model
 from mpl_toolkits.mplot3d import Axes3D
 sys.path.append('.')
-from src.classes import Dataset, deprocess, Image
-from src.models import *
+from src.classes import Dataset, deprocess
+from src.cache import cache
+from src.features import FeatureExtractor
+from src.aggregate import GroupBy
+from src.evaluation import evaluate, save_results, RESULTS_PATH
+from src.projection import cached_projection, cached_embedding
+from src.labels import PatchLabels
+from src.metadata import TXT_PATH
 
 
 logger = logging.getLogger(__name__)
-CACHE_PATH = '.cache/'
+SAMPLES_FILE = TXT_PATH + 'GTEx_v7_Annotations_SampleAttributesDS.txt'
 
 
-def get_tissue_IDs(dataset_name, image_objs, cache=True):
+def get_tissue_IDs(dataset_name, labels, use_cache=True):
 
-    caching_hash = hashlib.sha256(
-        ''.join([x.ID.GTEx_ID for x in image_objs]).encode('utf-8')
-    ).hexdigest()
-    filepath = CACHE_PATH + dataset_name + f'_{caching_hash}_tissue_IDs.pkl'
+    key = cache.key(
+        'tissue_IDs',
+        params={
+            'dataset_name': dataset_name,
+            'fingerprint': labels.fingerprint,
+        },
+        code=[get_tissue_IDs, PatchLabels],
+        files=[SAMPLES_FILE]
+    )
+    tissue_IDs = cache.get(key) if use_cache else None
 
-    if isfile(filepath) and cache:
-        logger.debug('Loading tissue IDs from cache')
-        tissue_IDs = pickle.load(open(filepath, 'rb'))
+    if tissue_IDs is not None:
+        logger.debug('Loaded tissue IDs from cache')
     else:
         logger.debug('Generating tissue IDs')
-        tissue_IDs = np.array([x.get_sample().tissue for x in image_objs])
-        pickle.dump(tissue_IDs, open(filepath, 'wb'))
+        tissue_IDs = labels.tissues()
+        cache.put(key, tissue_IDs)
 
     return tissue_IDs
 
 
-def generate_features(features_ID, patches, model_file_id):
-    filepath = CACHE_PATH + features_ID + '.pkl'
-    if isfile(filepath):
-        logger.debug('Loading features from cache')
-        features = pickle.load(open(filepath, 'rb'))
-    else:
-        logger.debug(f'Generating {model_file_id} features')
-        m = load_model(
-            'models/' + model_file_id + '.pkl'
-        )
-        encoder = Model(m.layers[0].input, m.layers[14].output)
-        features = encoder.predict(patches)
-        pickle.dump(features, open(filepath, 'wb'))
-    return features
+def generate_features(patches, GTEx_IDs, patch_set, image_keys,
+                      model_file_id, batch_size=256):
+    logger.debug(f'Generating {model_file_id} features')
+    extractor = FeatureExtractor(
+        'models/' + model_file_id + '.pkl', batch_size=batch_size
+    )
+    return extractor.extract(patches, GTEx_IDs, patch_set, image_keys)
 
 
-def plot_PCA(dataset_name, features, image_objs, mode):
+def plot_PCA(dataset_name, features_ID, features, labels, mode,
+             method='randomized'):
 
     # pca = PCA()
     # pca_features = pca.fit_transform(features)
@@ -145,15 +142,16 @@ def plot_PCA(dataset_name, features, image_objs, mode):
 
 
     factor_IDs, unique_factor_IDs = generate_factors(
-        dataset_name, image_objs, mode
+        dataset_name, labels, mode
     )
 
     hot = plt.get_cmap('plasma')
     cNorm = colors.Normalize(vmin=0, vmax=len(unique_factor_IDs))
     scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=hot)
     # colors = ['blue', 'green', 'yellow', 'red', 'black', 'purple']
-    pca = PCA()
-    pca_features = pca.fit_transform(features)
+    pca_features, explained_variance = cached_projection(
+        features_ID, features, n_components=3, method=method
+    )
     fig = plt.figure(figsize=(10, 10))
     # ax = fig.add_subplot(111, projection='3d')
     # for f in np.unique(factor_IDs):
@@ -171,14 +169,38 @@ def plot_PCA(dataset_name, features, image_objs, mode):
             color=scalarMap.to_rgba(f), label=unique_factor_IDs[f], alpha=0.5
         )
 
-    ax.set_xlabel('PC1')
-    ax.set_ylabel('PC2')
-    ax.set_zlabel('PC3')
+    ax.set_xlabel(f'PC1 ({explained_variance[0]:.1%})')
+    ax.set_ylabel(f'PC2 ({explained_variance[1]:.1%})')
+    ax.set_zlabel(f'PC3 ({explained_variance[2]:.1%})')
     plt.title('Hello')
     ax.legend()
     plt.show()
 
 
+def plot_embedding(dataset_name, features_ID, features, labels, mode,
+                   n_samples=10000):
+    """2D t-SNE of a subsample of the features, coloured by factor"""
+    factor_IDs, unique_factor_IDs = generate_factors(
+        dataset_name, labels, mode
+    )
+    idx, embedding = cached_embedding(features_ID, features, n_samples)
+    factor_IDs = np.asarray(factor_IDs)[idx]
+
+    hot = plt.get_cmap('plasma')
+    cNorm = colors.Normalize(vmin=0, vmax=len(unique_factor_IDs))
+    scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=hot)
+    fig = plt.figure(figsize=(10, 10))
+    ax = fig.add_subplot(111)
+    for f in np.unique(factor_IDs):
+        f_idx = factor_IDs == f
+        ax.scatter(
+            embedding[f_idx, 0], embedding[f_idx, 1],
+            color=scalarMap.to_rgba(f), label=unique_factor_IDs[f], alpha=0.5
+        )
+    plt.title(f't-SNE of {len(idx)} of {len(features)} features')
+    ax.legend()
+    plt.show()
+
 
 def get_variable_name(*variable):
     '''gets string of variable name
@@ -196,43 +218,45 @@ def get_variable_name(*variable):
 
 
 def train_classifiers(dataset_name, features_ID, features,
-                      image_objs, mode, retrain=False):
+                      labels, mode, retrain=False, folds=1,
+                      kernel='auto', workers=-1):
 
     factor_IDs, unique_factor_IDs = generate_factors(
-        dataset_name, image_objs, mode
+        dataset_name, labels, mode
     )
 
-    factor_hash = hashlib.sha256(
-        ''.join([x.ID.GTEx_ID for x in image_objs]).encode('utf-8')
-    ).hexdigest()
-
-    filepath = CACHE_PATH + features_ID \
-                          + f'_{mode}_{factor_hash}_classifiers.pkl'
-
-    X_train, X_test, y_train, y_test = train_test_split(
-        features, factor_IDs,
-        stratify=factor_IDs,
-        test_size=0.25, random_state=42
+    key = cache.key(
+        'classifiers',
+        params={
+            'features_ID': features_ID,
+            'features': hashlib.sha256(features.tobytes()).hexdigest(),
+            'fingerprint': labels.fingerprint,
+            'mode': mode,
+            'folds': folds,
+            'kernel': kernel,
+        },
+        code=[train_classifiers, evaluate],
+        seed=42
     )
-    if isfile(filepath) and not retrain:
-        logger.debug(f'Loading {mode} classifiers from cache')
-        lr, svm, rf = pickle.load(open(filepath, 'rb'))
-    else:
-        logger.debug('Training classifier')
-
-        lr = LogisticRegression()
-        svm = SVC(probability=True)
-        rf = RandomForestClassifier()
-
-        lr.fit(X_train, y_train)
-        svm.fit(X_train, y_train)
-        rf.fit(X_train, y_train)
 
-        pickle.dump([lr, svm, rf], open(filepath, 'wb'))
+    classifiers = cache.get(key) if not retrain else None
+    if classifiers is not None:
+        logger.debug(f'Loaded {mode} classifiers from cache')
+        estimators, records = classifiers
+    else:
+        logger.debug('Training classifiers')
+        estimators, records = evaluate(
+            features, factor_IDs, kernel=kernel, folds=folds,
+            workers=workers, random_state=42
+        )
+        cache.put(key, [estimators, records])
 
-    lr_score = lr.score(X_test, y_test)
-    svm_score = svm.score(X_test, y_test)
-    rf_score = rf.score(X_test, y_test)
+    results = save_results(
+        records, RESULTS_PATH + f'{features_ID}_{mode}_classifiers.csv'
+    )
+    summary = results.groupby('model').agg({
+        'accuracy': ['mean', 'std'], 'fit_seconds': 'mean'
+    })
 
     print(
         (
@@ -241,68 +265,74 @@ def train_classifiers(dataset_name, features_ID, features,
         )
     )
 
-    print(f'n_train: {len(X_train)}, n_test: {len(X_test)}')
     print(
-        (
-            f'LR: {lr_score:.3f}\n'
-            f'SVM: {svm_score:.3f}\n'
-            f'RF: {rf_score:.3f}'
-        )
+        f"n_train: {records[0]['n_train']}, n_test: {records[0]['n_test']}, "
+        f"folds: {folds}, kernel: {records[0]['kernel']}"
     )
-    return lr_score, svm_score, rf_score
-
-
-def aggregate_features(dataset_name, features, image_objs, mode, aggregation):
+    print(summary.to_string())
+    scores = summary['accuracy']['mean']
+    return scores['LR'], scores['SVM'], scores['RF']
+
+
+def aggregate_features(dataset_name, features, labels, mode,
+                       aggregations=('mean',)):
+    """
+    Aggregate patch features per factor of mode with each of
+    aggregations in a single sorted pass. Returns a dict of
+    (n_factors, n_features) arrays by aggregation name, and the labels
+    of the first patch of each factor.
+    """
     logger.debug('Aggregating features')
 
     factor_IDs, unique_factor_IDs = generate_factors(
-        dataset_name, image_objs, mode
+        dataset_name, labels, mode
     )
 
-    n_factors = len(unique_factor_IDs)
-    aggregated_features = np.zeros((n_factors, features.shape[1]))
-    aggregated_image_objs = []
+    groups = GroupBy(factor_IDs)
+    aggregated_features = groups.aggregate(features, aggregations)
+    aggregated_labels = labels.subset(groups.first())
 
-    for f in np.unique(factor_IDs):
-        f_idx = factor_IDs == f
-        f_image_objs = np.array(image_objs)[f_idx].tolist()
-        f_features = features[f_idx]
-        aggregated_feature = aggregation(f_features, 0)
-        aggregated_features[f] = aggregated_feature
-        aggregated_image_objs.append(f_image_objs[0])
-
-    return aggregated_features, aggregated_image_objs
+    return aggregated_features, aggregated_labels
 
 
-def generate_factors(dataset_name, image_objs, mode):
+def generate_factors(dataset_name, labels, mode):
     logger.debug('Generating factors')
-    factor_hash = hashlib.sha256(
-        ''.join([x.ID.GTEx_ID for x in image_objs]).encode('utf-8')
-    ).hexdigest()
-
-    filepath = CACHE_PATH + f'{mode}_factors_{factor_hash}'
-    if isfile(filepath):
-        logger.debug('Loading factor IDs from cache')
-        factor_IDs, unique_factor_IDs = pickle.load(open(filepath, 'rb'))
+    key = cache.key(
+        'factors',
+        params={
+            'fingerprint': labels.fingerprint,
+            'mode': mode,
+        },
+        code=[generate_factors, get_tissue_IDs, PatchLabels],
+        files=[SAMPLES_FILE]
+    )
+    factors = cache.get(key)
+    if factors is not None:
+        logger.debug('Loaded factor IDs from cache')
+        factor_IDs, unique_factor_IDs = factors
     else:
         logger.debug('Generating factor IDs')
         if mode == 'tissue_IDs':
-            tissue_IDs = get_tissue_IDs(dataset_name, image_objs, cache=False)
+            tissue_IDs = get_tissue_IDs(
+                dataset_name, labels, use_cache=False
+            )
             factor_IDs, unique_factor_IDs = pd.factorize(tissue_IDs)
         elif mode == 'GTEx_IDs':
-            GTEx_IDs = [image.ID.GTEx_ID for image in image_objs]
-            factor_IDs, unique_factor_IDs = pd.factorize(GTEx_IDs)
-        pickle.dump([factor_IDs, unique_factor_IDs], open(filepath, 'wb'))
+            factor_IDs, unique_factor_IDs = pd.factorize(labels.imageIDs)
+        elif mode == 'donor_IDs':
+            donor_IDs = labels.donors()
+            factor_IDs, unique_factor_IDs = pd.factorize(donor_IDs)
+        cache.put(key, [factor_IDs, unique_factor_IDs])
 
     return factor_IDs, unique_factor_IDs
 
 
-def subselect_tissue(dataset_name, tissue, features, image_objs):
-    tissue_IDs = get_tissue_IDs(dataset_name, image_objs)
+def subselect_tissue(dataset_name, tissue, features, labels):
+    tissue_IDs = get_tissue_IDs(dataset_name, labels)
     tissue_idx = tissue_IDs == tissue
     tissue_features = features[tissue_idx, :]
-    tissue_image_objs = np.array(image_objs)[tissue_idx].tolist()
-    return tissue_features, tissue_image_objs
+    tissue_labels = labels.subset(tissue_idx)
+    return tissue_features, tissue_labels
 
 
 @click.command()
@@ -327,36 +357,68 @@ def subselect_tissue(dataset_name, tissue, features, image_objs):
     default='CA_ps128_n12000_e500_lr0.0001_bs64_dim256_do0.5',
     help="Model file ID to generate features from"
 )
-def main(n_images, n_tissues, n_patches, patch_size, model_file_id):
+@click.option(
+    '--seed', default=42,
+    help="Seed of the patch sampling plan"
+)
+@click.option(
+    '--batch_size', default=256,
+    help="Number of patches encoded per batch"
+)
+@click.option(
+    '--folds', default=1,
+    help="Number of stratified folds, or 1 for a single 75/25 split"
+)
+@click.option(
+    '--kernel', default='auto',
+    type=click.Choice(['auto', 'exact', 'nystroem', 'linear']),
+    help=(
+        "SVM kernel: exact RBF, Nystroem approximated RBF, linear, or "
+        "exact unless there are too many training patches"
+    )
+)
+@click.option(
+    '--workers', default=-1,
+    help="Number of classifier fits run in parallel, -1 for all cores"
+)
+def main(n_images, n_tissues, n_patches, patch_size, model_file_id, seed,
+         batch_size, folds, kernel, workers):
     logger.info('Initializing cluster_classify script')
     dataset = Dataset(n_tissues=n_tissues, n_images=n_images)
-    data = dataset.sample_data(patch_size, n_patches)
+    data = dataset.sample_data(patch_size, n_patches, seed=seed)
     patches, GTEx_IDs = data
-    image_objs = [Image(x) for x in GTEx_IDs]
+    labels = PatchLabels(GTEx_IDs)
 
     dataset_name = ''.join([s for s in str(dataset) if s.isalnum()])
     features_ID = dataset_name + f'_{n_patches}_{patch_size}_{n_images}' \
-                               + model_file_id
+                               + model_file_id + f'_seed{seed}'
 
-    features = generate_features(features_ID, patches, model_file_id)
-
-    a_features, a_image_objs = aggregate_features(
-        dataset_name, features, image_objs, 'GTEx_IDs', np.mean
+    patch_set = f'ps{patch_size}_n{n_patches}_seed{seed}'
+    image_keys = dataset.patch_keys(patch_size, n_patches, seed)
+    features = generate_features(
+        patches, GTEx_IDs, patch_set, image_keys, model_file_id, batch_size
     )
 
-    a_features, a_image_objs = aggregated_features['GTEx_factor_IDs']['np.mean']
+    aggregated_features, a_labels = aggregate_features(
+        dataset_name, features, labels, 'GTEx_IDs', ('mean', 'median')
+    )
+    a_features = aggregated_features['mean']
 
-    lung_features, lung_image_objs = subselect_tissue(
-        dataset_name, 'Lung', features, image_objs
+    lung_features, lung_labels = subselect_tissue(
+        dataset_name, 'Lung', features, labels
     )
 
     train_classifiers(
-        dataset_name, features_ID, lung_features, lung_image_objs, 'GTEx_IDs',
-        retrain=True
+        dataset_name, features_ID, lung_features, lung_labels, 'GTEx_IDs',
+        retrain=True, folds=folds, kernel=kernel, workers=workers
     )
+    logger.info(f'Cache: {cache.report()}')
 
 
-    # plot_PCA(dataset_name, a_features, a_image_objs, 'tissue_IDs')
+    # plot_PCA(
+    #     dataset_name, features_ID + '_GTEx_IDs_mean', a_features,
+    #     a_labels, 'tissue_IDs'
+    # )
 
     # plt.show()
 
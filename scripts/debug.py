@@ -26,7 +26,7 @@ def main():
     for i in tqdm(range(len(imageIDs_data))):
         GTEx_ID = imageIDs_data[i]
         idx = i % 50
-        scipy.misc.imsave(f'data/cellprofiler/patches/{i:04d}_{GTEx_ID}_{idx}.png', 255 - patches_data[i])
+        scipy.misc.imsave(f'data/cellprofiler/patches/{i:04d}_{GTEx_ID}_{idx}.png', patches_data[i])
 
 if __name__ == '__main__':
     logging.basicConfig(
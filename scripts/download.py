@@ -20,11 +20,15 @@ logger = logging.getLogger(__name__)
     '--n_tissues', default=6,
     help="Number of tissues with most numbers of samples"
 )
-def main(n_images, n_tissues):
+@click.option(
+    '--workers', default=4,
+    help="Number of images to download concurrently"
+)
+def main(n_images, n_tissues, workers):
     os.makedirs('data/images', exist_ok=True)
     logger.info('Initializing download script')
     dataset = Dataset(n_images=n_images, n_tissues=n_tissues)
-    dataset.download()
+    dataset.download(workers=workers)
 
 
 if __name__ == '__main__':
@@ -2,6 +2,7 @@ import sys
 import logging
 import click
 import os
+import time
 sys.path.append('.')
 from src.classes import Dataset
 
@@ -17,11 +18,39 @@ logger = logging.getLogger(__name__)
     '--n_tissues', default=6,
     help="Number of tissues with most numbers of samples"
 )
-def main(n_images, n_tissues):
+@click.option(
+    '--workers', default=1,
+    help="Number of worker processes generating patches in parallel"
+)
+@click.option(
+    '--method', default='tile',
+    type=click.Choice(['tile', 'fast', 'multiscale']),
+    help=(
+        "Measure whitespace on every full resolution tile, estimate it "
+        "from the downsampled region, or measure all patch sizes in a "
+        "single pass"
+    )
+)
+@click.option(
+    '--verify_band', default=0.05,
+    help=(
+        "With --method fast, verify candidates whose estimated whitespace "
+        "is this close to the threshold at full resolution"
+    )
+)
+def main(n_images, n_tissues, workers, method, verify_band):
     os.makedirs('data/patches', exist_ok=True)
     logger.info('Initializing patches script')
     dataset = Dataset(n_images=n_images, n_tissues=n_tissues)
-    dataset.get_patchcoordfiles()
+    start = time.time()
+    results = dataset.get_patchcoordfiles(
+        workers=workers, method=method, verify_band=verify_band
+    )
+    seconds = sum(r['seconds'] for r in results)
+    logger.info(
+        f'Generated patches for {len(results)} images in '
+        f'{time.time() - start:.1f}s ({seconds:.1f}s of worker time)'
+    )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,173 @@
+import sys
+import requests.packages.urllib3
+import click
+import os
+import logging
+import numpy as np
+requests.packages.urllib3.disable_warnings()
+sys.path.append('.')
+from src.cache import cache
+from src.classes import Dataset
+from src.sweep import (
+    SEARCH_SPACE, REGISTRY_PATH, Registry, grid_configs, random_configs,
+    run_sweep
+)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_values(string, kind):
+    """Comma separated values, or a low:high range for random search"""
+    if ':' in string:
+        low, high = string.split(':')
+        return (kind(low), kind(high))
+    return [kind(value) for value in string.split(',')]
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.option(
+    '--name', required=True,
+    help="Name of the sweep in the registry"
+)
+@click.option(
+    '--n_tissues', default=6,
+    help="Number of tissues with most numbers of samples"
+)
+@click.option(
+    '--n_images', default=10,
+    help="Number of images per tissue"
+)
+@click.option(
+    '--n_patches', default=100,
+    help="Number of patches to sample from each image"
+)
+@click.option(
+    '--patch_size', default=128,
+    help="Patchsize to use"
+)
+@click.option(
+    '--model_type', default='ConvolutionalAutoencoder',
+    type=click.Choice([
+        'ConvolutionalAutoencoder', 'VariationalConvolutionalAutoencoder'
+    ]),
+    help="Model to train in every trial"
+)
+@click.option('--epochs', default=100, help="Epochs of every trial")
+@click.option('--inner_dim', default='256,512', help="Values of inner_dim")
+@click.option('--lr', default='0.0001,0.0005', help="Values of lr")
+@click.option('--beta_1', default='0.05,0.5', help="Values of beta_1")
+@click.option('--batch_size', default='64', help="Values of batch_size")
+@click.option(
+    '--dropout_rate', default='0.5', help="Values of dropout_rate"
+)
+@click.option(
+    '--search', default='grid', type=click.Choice(['grid', 'random']),
+    help=(
+        "Train every combination of the values, or n_trials random "
+        "combinations, where low:high values are sampled log-uniformly"
+    )
+)
+@click.option(
+    '--n_trials', default=10,
+    help=(
+        "Number of distinct configurations of a random search, at most "
+        "every combination of the values when none are ranges"
+    )
+)
+@click.option(
+    '--seed', default=42,
+    help="Seed of the patch sampling plan and of the random search"
+)
+@click.option(
+    '--workers', default=1,
+    help="Number of trials trained concurrently"
+)
+@click.option(
+    '--threads', default=None, type=int,
+    help="Threads of every trial, by default the CPUs shared by workers"
+)
+@click.option(
+    '--registry', default=REGISTRY_PATH,
+    help="sqlite database the trials are recorded in"
+)
+def run(name, n_tissues, n_images, n_patches, patch_size, model_type,
+        epochs, inner_dim, lr, beta_1, batch_size, dropout_rate, search,
+        n_trials, seed, workers, threads, registry):
+    np.random.seed(seed)
+    os.makedirs('models', exist_ok=True)
+    values = {
+        'inner_dim': inner_dim,
+        'lr': lr,
+        'beta_1': beta_1,
+        'batch_size': batch_size,
+        'dropout_rate': dropout_rate,
+    }
+    space = {
+        param: parse_values(values[param], kind)
+        for (param, kind) in SEARCH_SPACE.items()
+    }
+    if search == 'grid':
+        assert not any(isinstance(v, tuple) for v in space.values()), \
+            "Ranges are only supported by random search"
+        configs = grid_configs(space)
+    else:
+        configs = random_configs(space, n_trials, seed)
+
+    dataset = Dataset(n_tissues=n_tissues, n_images=n_images)
+    patches_data, _ = dataset.sample_data(
+        patch_size, int(n_patches), seed=seed, workers=workers
+    )
+    storepath = os.path.dirname(patches_data.filename)
+    del patches_data
+
+    trials = run_sweep(
+        name, model_type, configs, storepath, patch_size, epochs,
+        workers=workers, threads=threads, registry=Registry(registry)
+    )
+    print(trials[[
+        'trial', 'status', *SEARCH_SPACE, 'final_loss', 'seconds'
+    ]].to_string(index=False))
+    logger.info(f'Cache: {cache.report()}')
+
+
+@main.command()
+@click.option('--name', default=None, help="Only show trials of a sweep")
+@click.option(
+    '--status', default=None, help="Only show trials with a status"
+)
+@click.option('--top', default=20, help="Number of best trials to show")
+@click.option(
+    '--registry', default=REGISTRY_PATH,
+    help="sqlite database the trials are recorded in"
+)
+def show(name, status, top, registry):
+    conditions, args = [], []
+    if name is not None:
+        conditions.append('sweep = ?')
+        args.append(name)
+    if status is not None:
+        conditions.append('status = ?')
+        args.append(status)
+    trials = Registry(registry).query(
+        ' AND '.join(conditions) or '1', tuple(args)
+    )
+    print(trials[[
+        'trial', 'sweep', 'model_type', 'status', *SEARCH_SPACE,
+        'final_loss', 'best_loss', 'seconds', 'samples_per_second'
+    ]].head(top).to_string(index=False))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        filename='logs/sweep.log', level=logging.DEBUG,
+        format=(
+            "%(asctime)s | %(name)s | %(processName)s"
+            " | %(levelname)s: %(message)s"
+        )
+    )
+    main()
@@ -6,7 +6,9 @@ import logging
 import numpy as np
 requests.packages.urllib3.disable_warnings()
 sys.path.append('.')
-from src.classes import Dataset
+from src.cache import cache
+from src.classes import Dataset, process
+from src.inputs import PatchStream, ArrayPatchSource, SlidePatchSource
 from src.models import (
     VariationalConvolutionalAutoencoder, ConvolutionalAutoencoder
 )
@@ -52,8 +54,24 @@ def extract_params(param_string):
         "Specify the hyperparameters of the model."
     )
 )
-def main(n_tissues, n_images, n_patches, patch_size, model_type, param_string):
-    np.random.seed(42)
+@click.option(
+    '--stream', default=None, type=click.Choice(['store', 'slides']),
+    help=(
+        "Stream batches with background workers from the patch store, or "
+        "directly from the slides, instead of iterating the patch array"
+    )
+)
+@click.option(
+    '--seed', default=42,
+    help="Seed of the patch sampling plan and of numpy"
+)
+@click.option(
+    '--workers', default=1,
+    help="Number of worker processes extracting the sampled patches"
+)
+def main(n_tissues, n_images, n_patches, patch_size, model_type, param_string,
+         stream, seed, workers):
+    np.random.seed(seed)
     os.makedirs('data/images', exist_ok=True)
     dataset = Dataset(n_tissues=n_tissues, n_images=n_images)
 
@@ -62,23 +80,33 @@ def main(n_tissues, n_images, n_patches, patch_size, model_type, param_string):
     params = extract_params(param_string)
     params['patch_size'] = patch_size
 
-    N = dataset.n_tissues * dataset.n_images * params['batch_size']
-
-    data = dataset.sample_data(patch_size, int(n_patches))
-    patches_data, imageIDs_data = data
+    if stream == 'slides':
+        images = [
+            image for images in dataset.images.values() for image in images
+        ]
+        patches_data = PatchStream(
+            SlidePatchSource(images, patch_size, int(n_patches)),
+            params['batch_size']
+        )
+    else:
+        data = dataset.sample_data(
+            patch_size, int(n_patches), seed=seed, workers=workers
+        )
+        patches_data, imageIDs_data = data
+        if stream == 'store':
+            patches_data = PatchStream(
+                ArrayPatchSource(patches_data), params['batch_size']
+            )
 
     if model_type == 'concrete_vae':
+        assert not stream, "concrete_vae trains on the full patch array"
         from dependencies.vae_concrete.vae_concrete import VAE
         m = VAE(latent_cont_dim=256)
-        m.fit(patches_data, num_epochs=20)
+        m.fit(process(patches_data), num_epochs=20)
 
     else:
         Model = eval(model_type)
         m = Model(inner_dim=params['inner_dim'])
-        N = patches_data.shape[0]
-        assert N == imageIDs_data.shape[0]
-        p = np.random.permutation(N)
-        patches_data, imageIDs_data = patches_data[p], imageIDs_data[p]
 
         m.train_on_data(
             patches_data, params
@@ -86,6 +114,10 @@ def main(n_tissues, n_images, n_patches, patch_size, model_type, param_string):
 
         m.save()
 
+    if stream:
+        patches_data.close()
+    logger.info(f'Cache: {cache.report()}')
+
 
 if __name__ == '__main__':
     logging.basicConfig(
@@ -11,7 +11,7 @@ import matplotlib.pyplot as plt
 from os.path import isfile
 requests.packages.urllib3.disable_warnings()
 sys.path.append('.')
-from src.classes import Dataset, deprocess
+from src.classes import Dataset, process, deprocess
 
 logger = logging.getLogger(__name__)
 MODEL_PATH = 'models/'
@@ -48,7 +48,7 @@ def main(n_tissues, n_images, n_patches, patch_size, model_file):
     K = 5
     N = patches_data.shape[0]
     idx = np.random.choice(range(N), K)
-    patches = patches_data[idx]
+    patches = process(patches_data[idx])
     if model_file:
         # fig, ax = plt.subplots(
         #     2, K, figsize=(8, 3)
@@ -0,0 +1,99 @@
+import re
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+REDUCTIONS = {
+    'sum': np.add,
+    'max': np.maximum,
+    'min': np.minimum,
+}
+
+
+def quantile_of(name):
+    """Quantile of an aggregation name such as 'median' or 'q90'"""
+    if name == 'median':
+        return 0.5
+    match = re.match(r'^q(\d+(\.\d+)?)$', name)
+    assert match, f'Unknown aggregation {name}'
+    q = float(match.group(1)) / 100
+    assert 0 <= q <= 1, f'Quantile out of range in {name}'
+    return q
+
+
+class GroupBy():
+    """
+    Groups the rows of arrays by a key per row. The keys are sorted once,
+    after which every aggregation is a segment reduction over contiguous
+    runs of rows (np.add.reduceat and friends), so aggregating is linear
+    in the number of rows however many groups there are. Quantiles are
+    computed on a (groups, size, dim) view when all groups have the same
+    size, and segment by segment otherwise.
+    """
+
+    def __init__(self, keys):
+        self.keys, inverse = np.unique(np.asarray(keys), return_inverse=True)
+        inverse = inverse.ravel()
+        self.order = np.argsort(inverse, kind='stable')
+        self.counts = np.bincount(inverse, minlength=len(self.keys))
+        self.starts = np.cumsum(self.counts) - self.counts
+
+    def __repr__(self):
+        return f"<GroupBy:{len(self.keys)}|N{len(self.order)}>"
+
+    def __len__(self):
+        return len(self.keys)
+
+    def first(self):
+        """Row of the first member of each group"""
+        return self.order[self.starts]
+
+    def aggregate(self, values, aggregations=('mean',)):
+        """
+        Aggregate the rows of values per group with each of aggregations,
+        returning a dict of (groups, ...) arrays by aggregation name.
+        Names are 'sum', 'mean', 'max', 'min', 'std', 'median' and
+        quantiles like 'q25'.
+        """
+        values = np.asarray(values)[self.order]
+        counts = self.counts.reshape((-1,) + (1,) * (values.ndim - 1))
+        results = {}
+        sums = None
+        for name in aggregations:
+            if name in REDUCTIONS:
+                results[name] = REDUCTIONS[name].reduceat(
+                    values, self.starts, axis=0
+                )
+            elif name in ('mean', 'std'):
+                if sums is None:
+                    sums = np.add.reduceat(
+                        values.astype(np.float64), self.starts, axis=0
+                    )
+                mean = sums / counts
+                if name == 'mean':
+                    results[name] = mean
+                else:
+                    squares = np.add.reduceat(
+                        np.square(values, dtype=np.float64),
+                        self.starts, axis=0
+                    )
+                    results[name] = np.sqrt(
+                        np.maximum(squares / counts - mean ** 2, 0)
+                    )
+            else:
+                results[name] = self.quantile(values, quantile_of(name))
+        return results
+
+    def quantile(self, values, q):
+        """q-quantile per group of values already sorted by group"""
+        if len(set(self.counts)) == 1:
+            return np.quantile(
+                values.reshape(
+                    (len(self.keys), self.counts[0]) + values.shape[1:]
+                ), q, axis=1
+            )
+        return np.stack([
+            np.quantile(values[start:start + count], q, axis=0)
+            for (start, count) in zip(self.starts, self.counts)
+        ])
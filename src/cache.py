@@ -0,0 +1,209 @@
+import os
+import re
+import json
+import pickle
+import time
+import shutil
+import hashlib
+import inspect
+import logging
+import tempfile
+from os.path import isfile, isdir, join, getsize, getmtime
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = '.cache/'
+CACHE_SIZE = 50 * 2**30
+ENTRY = re.compile(r'^\w+-[0-9a-f]{16}(\.pkl)?$')
+# Directories being written by a PatchStore of process pid, and files being
+# written by Cache.put
+TEMP_ENTRY = re.compile(
+    r'^\w+-[0-9a-f]{16}\.(?:(?:tmp|old)(?P<pid>\d+)|\w{8})$'
+)
+TEMP_AGE = 24 * 60 * 60
+
+
+def fingerprint(obj):
+    """Stable JSON serialization of params, arrays and objects for keys"""
+    return json.dumps(
+        obj, sort_keys=True,
+        default=lambda o: o.tolist() if hasattr(o, 'tolist') else repr(o)
+    )
+
+
+def source_of(obj):
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        return repr(obj)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def stale_temp(name, path, max_age=TEMP_AGE):
+    """Whether name is a temporary entry its writer left behind"""
+    match = TEMP_ENTRY.match(name)
+    if not match:
+        return False
+    if match.group('pid'):
+        return not pid_alive(int(match.group('pid')))
+    return time.time() - getmtime(path) > max_age
+
+
+def entry_size(path):
+    if isdir(path):
+        return sum(
+            getsize(join(root, name))
+            for (root, _, names) in os.walk(path) for name in names
+        )
+    return getsize(path)
+
+
+class Cache():
+    """
+    Size-bounded cache of pickled values and directories in CACHE_PATH.
+    Entries are keyed by a hash of everything that determines them: a
+    namespace, parameters, the source code of the functions producing
+    them, the size and mtime of their input files and the random seed,
+    so changing any of these misses instead of reusing a stale entry.
+    Values are written to a temporary file and renamed into place, and
+    the least recently used entries are evicted once the cache grows
+    beyond max_bytes.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+    def __repr__(self):
+        return (
+            f"<Cache:{self.path}|H{self.stats['hits']}"
+            f"M{self.stats['misses']}>"
+        )
+
+    def key(self, namespace, params=None, code=(), files=(), seed=None):
+        """Content hash key of an entry in namespace"""
+        assert re.match(r'^\w+$', namespace), f'Bad namespace {namespace}'
+        digest = hashlib.sha256()
+        digest.update(fingerprint(params).encode('utf-8'))
+        for obj in code:
+            digest.update(source_of(obj).encode('utf-8'))
+        for filepath in files:
+            if isfile(filepath):
+                stat = os.stat(filepath)
+                digest.update(
+                    f'{filepath}:{stat.st_size}:{stat.st_mtime_ns}'.encode()
+                )
+            else:
+                digest.update(f'{filepath}:missing'.encode())
+        digest.update(fingerprint(seed).encode('utf-8'))
+        return f'{namespace}-{digest.hexdigest()[:16]}'
+
+    def filepath(self, key):
+        return join(self.path, key + '.pkl')
+
+    def dirpath(self, key):
+        """Path of a directory entry, such as a PatchStore"""
+        return join(self.path, key)
+
+    def hit(self, key):
+        """Record a hit on key and mark it as recently used"""
+        self.stats['hits'] += 1
+        for path in (self.filepath(key), self.dirpath(key)):
+            if os.path.exists(path):
+                os.utime(path)
+        logger.debug(f'Cache hit {key}')
+
+    def miss(self, key):
+        self.stats['misses'] += 1
+        logger.debug(f'Cache miss {key}')
+
+    def added(self, key):
+        """Record a new entry written under key and evict older entries"""
+        self.stats['writes'] += 1
+        self.evict(keep=[key])
+
+    def get(self, key, default=None):
+        """Unpickle the value of key, or return default on a miss"""
+        filepath = self.filepath(key)
+        if isfile(filepath):
+            try:
+                with open(filepath, 'rb') as f:
+                    value = pickle.load(f)
+                self.hit(key)
+                return value
+            except (EOFError, pickle.UnpicklingError):
+                logger.exception(f'Removing unreadable cache entry {key}')
+                os.remove(filepath)
+        self.miss(key)
+        return default
+
+    def put(self, key, value):
+        """Atomically pickle value under key"""
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=self.path, prefix=key + '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f)
+            os.replace(tmppath, self.filepath(key))
+        except BaseException:
+            os.remove(tmppath)
+            raise
+        self.added(key)
+        return value
+
+    def evict(self, keep=()):
+        """
+        Remove temporary entries left behind by crashed writers, then
+        least recently used entries until under max_bytes.
+        """
+        if not isdir(self.path):
+            return
+        keep = {k for key in keep for k in (key, key + '.pkl')}
+        entries = []
+        for name in os.listdir(self.path):
+            path = join(self.path, name)
+            if ENTRY.match(name):
+                entries.append((getmtime(path), entry_size(path), name))
+            elif stale_temp(name, path):
+                logger.debug(f'Removing stale temporary entry {name}')
+                if isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, name) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name in keep:
+                continue
+            path = join(self.path, name)
+            logger.debug(f'Evicting {name} ({size / 2**20:.1f}MB)')
+            if isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            total -= size
+            self.stats['evictions'] += 1
+
+    def report(self):
+        """Summary of the hits, misses and writes of this process"""
+        requests = self.stats['hits'] + self.stats['misses']
+        rate = self.stats['hits'] / requests if requests else 0
+        return (
+            f"{self.stats['hits']} hits, {self.stats['misses']} misses "
+            f"({rate:.0%}), {self.stats['writes']} writes, "
+            f"{self.stats['evictions']} evictions"
+        )
+
+
+cache = Cache()
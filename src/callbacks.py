@@ -1,18 +1,27 @@
 from keras.callbacks import Callback
 import tensorflow as tf
 import numpy as np
+import pandas as pd
+import os
+import csv
+import time
+import logging
+import resource
+import threading
+from queue import Queue
+from .classes import deprocess
+
+logger = logging.getLogger(__name__)
 
 
 def make_image(tensor):
     """
-    Convert an numpy representation image to Image protobuf.
+    Convert an numpy representation uint8 image to Image protobuf.
     Copied from https://github.com/lanpa/tensorboard-pytorch/
     """
     from PIL import Image
-    tensor = np.squeeze(tensor)
     height, width, channel = tensor.shape
 
-    tensor = np.floor(tensor * 256).astype('uint8')
     image = Image.fromarray(tensor)
     import io
     output = io.BytesIO()
@@ -25,27 +34,163 @@ def make_image(tensor):
     )
 
 
+def preview_grid(patches, decoded_patches):
+    """One row per patch of the patch next to its reconstruction"""
+    return np.concatenate([
+        np.concatenate([deprocess(patch), deprocess(decoded)], axis=1)
+        for (patch, decoded) in zip(patches, decoded_patches)
+    ], axis=0)
+
+
 class TensorBoardImage(Callback):
-    def __init__(self, patches_data, tag):
+    """
+    Logs a fixed batch of preview patches next to their reconstructions
+    every interval epochs. The previews are predicted in one call and
+    handed to a background thread, which PNG encodes them and writes
+    them with a FileWriter kept open for the whole of training, so the
+    end of an epoch only waits for the prediction.
+    """
+
+    def __init__(self, patches_data, tag, log_dir='./tensorboardlogs',
+                 interval=1, max_pending=4):
         super().__init__()
         self.patches_data = patches_data
         self.tag = tag
+        self.log_dir = log_dir
+        self.interval = interval
+        self.queue = Queue(maxsize=max_pending)
+        self.writer = None
+        self.thread = None
 
-    def on_epoch_end(self, epoch, logs={}):
-        # Load image
-        patch = self.patches_data[0]
-        s = patch.shape[0]
-        decoded_patch = self.model.predict(
-            np.reshape(patch, (1, s, s, 3))
-        )
-        double_patch = np.zeros((s, 2 * s, 3))
-        double_patch[:, 0:s, :] = 255 - patch
-        double_patch[:, s:, :] = 255 - decoded_patch
+    def on_train_begin(self, logs=None):
+        self.writer = tf.summary.FileWriter(self.log_dir)
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
 
-        image = make_image(double_patch)
-        summary = tf.Summary(
-            value=[tf.Summary.Value(tag=self.tag, image=image)]
+    def on_epoch_end(self, epoch, logs=None):
+        if epoch % self.interval:
+            return
+        decoded_patches = self.model.predict(
+            self.patches_data, batch_size=len(self.patches_data)
         )
-        writer = tf.summary.FileWriter('./tensorboardlogs')
-        writer.add_summary(summary, epoch)
-        writer.close()
+        self.queue.put((epoch, decoded_patches))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            epoch, decoded_patches = item
+            try:
+                image = make_image(
+                    preview_grid(self.patches_data, decoded_patches)
+                )
+                summary = tf.Summary(
+                    value=[tf.Summary.Value(tag=self.tag, image=image)]
+                )
+                self.writer.add_summary(summary, epoch)
+            except Exception:
+                logger.exception(f'Failed to log preview of epoch {epoch}')
+
+    def on_train_end(self, logs=None):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def throughput_report(filepath):
+    """Per-epoch totals of a ThroughputMonitor CSV as a DataFrame"""
+    batches = pd.read_csv(filepath)
+    epochs = batches.groupby('epoch').agg({
+        'size': 'sum', 'wait_seconds': 'sum', 'step_seconds': 'sum',
+        'peak_rss_mb': 'max'
+    })
+    seconds = epochs['wait_seconds'] + epochs['step_seconds']
+    epochs['samples_per_second'] = epochs['size'] / seconds
+    epochs['wait_fraction'] = epochs['wait_seconds'] / seconds
+    return epochs
+
+
+class ThroughputMonitor(Callback):
+    """
+    Records for every batch the time spent waiting for the input pipeline
+    to deliver it, the time spent in the training step, the resulting
+    samples per second and the peak RSS of the process. Batches are
+    appended to throughput.csv in log_dir at the end of every epoch and
+    the epoch totals are written as TensorBoard scalars, showing whether
+    training is bound by its input or by the model.
+    """
+
+    FIELDS = (
+        'epoch', 'batch', 'size', 'wait_seconds', 'step_seconds',
+        'samples_per_second', 'peak_rss_mb'
+    )
+
+    def __init__(self, log_dir):
+        super().__init__()
+        self.log_dir = log_dir
+        self.filepath = os.path.join(log_dir, 'throughput.csv')
+        self.writer = None
+        self.rows = []
+
+    def on_train_begin(self, logs=None):
+        os.makedirs(self.log_dir, exist_ok=True)
+        with open(self.filepath, 'w', newline='') as f:
+            csv.writer(f).writerow(self.FIELDS)
+        self.writer = tf.summary.FileWriter(self.log_dir)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.rows = []
+        self.last_end = time.time()
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_start = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        end = time.time()
+        wait = self.batch_start - self.last_end
+        step = end - self.batch_start
+        size = (logs or {}).get('size', 0)
+        self.rows.append((
+            self.epoch, batch, size, wait, step,
+            size / (wait + step) if wait + step > 0 else 0, peak_rss()
+        ))
+        self.last_end = end
+
+    def on_epoch_end(self, epoch, logs=None):
+        rows = self.rows
+        with open(self.filepath, 'a', newline='') as f:
+            csv.writer(f).writerows(rows)
+        if not rows:
+            return
+        size, wait, step = np.array([row[2:5] for row in rows]).sum(axis=0)
+        scalars = {
+            'throughput/samples_per_second': size / (wait + step),
+            'throughput/wait_fraction': wait / (wait + step),
+            'throughput/wait_seconds': wait,
+            'throughput/step_seconds': step,
+            'throughput/peak_rss_mb': max(row[6] for row in rows),
+        }
+        summary = tf.Summary(value=[
+            tf.Summary.Value(tag=tag, simple_value=float(value))
+            for (tag, value) in scalars.items()
+        ])
+        self.writer.add_summary(summary, epoch)
+        self.writer.flush()
+
+    def on_train_end(self, logs=None):
+        self.writer.close()
+        epochs = throughput_report(self.filepath)
+        if len(epochs):
+            logger.info(
+                f"Throughput: {epochs['samples_per_second'].mean():.1f} "
+                f"samples/s, {epochs['wait_fraction'].mean():.0%} of time "
+                f"waiting for input, peak RSS "
+                f"{epochs['peak_rss_mb'].max():.0f}MB"
+            )
@@ -1,10 +1,9 @@
 import pandas as pd
 import logging
-import requests
 import cv2
 import mahotas
-import pickle
-import joblib
+import os
+import time
 from os.path import isfile
 from openslide import open_slide
 from openslide.deepzoom import DeepZoomGenerator
@@ -12,67 +11,74 @@ import numpy as np
 from tqdm import tqdm
 from tables import open_file, Atom, Filters
 from collections import Counter
+from .download import Downloader
+from .store import PatchStore
+from .pool import run_pool
+from .cache import cache
+from .sampling import SamplePlan, draw_indices
+from .metadata import Metadata, lazy_attribute, TXT_PATH
 
 logger = logging.getLogger(__name__)
 
-TXT_PATH = 'txt/'
 IMAGE_PATH = 'data/images/'
 PATCH_PATH = 'data/patches/'
-CACHE_PATH = '.cache/'
+PATCH_SIZES = [128, 256, 512, 1024]
 
 
 class Image():
+    __slots__ = (
+        'imageID', 'ID', 'imagefilepath', 'patchcoordsfilepath',
+        'patchcoordsfile', 'tilesource'
+    )
+
     def __init__(self, imageID):
         self.imageID = imageID
         self.ID = ID(imageID)
         self.imagefilepath = IMAGE_PATH + self.imageID + ".svs"
         self.patchcoordsfilepath = PATCH_PATH + self.imageID + ".hdf5"
         self.patchcoordsfile = None
+        self.tilesource = None
 
     def __repr__(self):
         return f"<Image:{self.ID.donor}-{self.ID.sample}>"
 
     def has_sample(self):
-        return self.imageID in set(Collection.sample_imageIDs)
+        return self.imageID in Metadata.by_imageID
 
     def get_sample(self):
-        return Collection.where(
-            'samples', lambda s: s.imageID == self.imageID
-        )[0]
+        return Collection.query(imageID=self.imageID)[0]
 
     def get_slide(self):
         logger.debug(f'Loading {self.imagefilepath}')
         return open_slide(self.imagefilepath)
 
+    def get_tilesource(self):
+        """Return the open TileSource for this image, opening it if needed"""
+        if self.tilesource is None:
+            self.tilesource = TileSource(self.get_slide())
+        return self.tilesource
+
+    def close_slide(self):
+        """Close the slide and evict its cached tile generators"""
+        if self.tilesource is not None:
+            self.tilesource.close()
+            self.tilesource = None
+
     def is_downloaded(self):
         return isfile(self.imagefilepath)
 
-    def download(self):
+    def download(self, downloader=None):
         if self.is_downloaded():
             logger.debug(f'{str(self)} is downloaded')
             return True
-        else:
-            logger.debug(f'Downloading {str(self)}')
-            session = requests.session()
-            URL = "https://brd.nci.nih.gov/brd/imagedownload/" + self.imageID
-            logger.debug(f'Getting URL for {str(self)}')
-            response = session.get(URL, stream=True)
-            if response.ok:
-                outfile = open(self.imagefilepath, 'wb')
-                total_length = 500 * ((2**10)**2)
-                chunk_size = 1024
-                expected_size = (total_length/1024) + 1
-                response_iter = response.iter_content(chunk_size=chunk_size)
-                for chunk in tqdm(response_iter, total=expected_size):
-                    if chunk:
-                        outfile.write(chunk)
-                        outfile.flush()
-                logger.debug(f'Successfully downloaded {str(self)}')
-                outfile.close()
-                return True
-            else:
-                logger.debug(f'Something wrong with {str(self)}')
-                return False
+        logger.debug(f'Downloading {str(self)}')
+        downloader = downloader or Downloader(workers=1)
+        result = downloader.download_worker(
+            self.imageID, self.imagefilepath
+        )
+        if not result['ok']:
+            logger.debug(f'Something wrong with {str(self)}')
+        return result['ok']
 
     def has_patchcoords(self):
         return isfile(self.patchcoordsfilepath)
@@ -84,7 +90,19 @@ class Image():
         )
         return patchcoordsfile
 
-    def generate_patchcoords(self):
+    def generate_patchcoords(self, method='tile', verify_band=0.05):
+        """
+        Select the tissue patch coordinates of each patch size.
+
+        method='tile' measures the whitespace of every candidate on its
+        full resolution tile. method='fast' estimates it from the
+        downsampled region and only reads full resolution tiles for
+        candidates within verify_band of the threshold. method='multiscale'
+        reads each full resolution region once and derives the whitespace
+        of every patch size from the same pixels.
+        """
+        assert method in ('tile', 'fast', 'multiscale'),\
+            f'Unknown method {method}'
         if self.has_patchcoords():
             patchcoordsfile = self.get_patchcoordsfile()
             return patchcoordsfile
@@ -92,15 +110,8 @@ class Image():
         logger.debug(
             f'Generating patches for {self.imageID}'
         )
-        filters = Filters(complib='zlib', complevel=5)
-        patchcoordsfile = open_file(
-            self.patchcoordsfilepath, mode='w',
-            title=f'{self.imageID} patches',
-            filters=filters
-        )
-
-        atom = Atom.from_dtype(np.dtype('uint16'))
-        slide = self.get_slide()
+        tilesource = self.get_tilesource()
+        slide = tilesource.slide
         dslevel = slide.level_count - 1
         dscoord = Coord(*slide.level_dimensions[-1])
         downsample = slide.level_downsamples[-1]
@@ -119,109 +130,322 @@ class Image():
         mask = np.zeros_like(blurreddsregion)
         mask[blurreddsregion < T_otsu] = 1
 
-        for patchsize in [128, 256, 512, 1024]:
+        if method == 'fast':
+            logger.debug('Computing whitespace integral image')
+            # Transparent pixels are white on the tiles, as in read_patches
+            rgb = dsregion[:, :, :3].copy()
+            rgb[dsregion[:, :, 3] == 0] = 255
+            whitespace_integral = integral_image(
+                (rgb > T_otsu).mean(axis=2)
+            )
 
-            logger.debug(
-                f'patchsize: {patchsize}'
+        patchcoords = {}
+        if method == 'multiscale':
+            logger.debug('Selecting patches at all sizes in a single pass')
+            patchcoords = multiscale_patchcoords(
+                slide, mask, T_otsu, PATCH_SIZES
             )
-            dsps = np.round(patchsize / downsample).astype(int)
-            limitcoord = Coord(*dsregion.shape[:2]) / dsps
-
-            logger.debug('Computing downsampled centers')
-            dscentercoords = [
-                Coord(
-                    int(dsps/2 + i*dsps),
-                    int(dsps/2 + j*dsps)
+        else:
+            for patchsize in PATCH_SIZES:
+
+                logger.debug(
+                    f'patchsize: {patchsize}'
                 )
-                for i in range(limitcoord.x - 1)
-                for j in range(limitcoord.y - 1)
-            ]
-            logger.debug('Computing mask coordinates')
-
-            assert (
-                dscentercoords[-1].x < mask.shape[0] and
-                dscentercoords[-1].y < mask.shape[1]
-            )
+                dsps = np.round(patchsize / downsample).astype(int)
+                limitcoord = Coord(*dsregion.shape[:2]) / dsps
 
-            mask_centers = list(filter(
-                lambda c: mask[c.x, c.y] == 1,
-                dscentercoords
-            ))
-            tile_generator = DeepZoomGenerator(
-                slide, tile_size=patchsize, overlap=0, limit_bounds=False
-            )
-            level_count = tile_generator.level_count - 1
+                logger.debug('Computing downsampled centers')
+                dscentercoords = grid_centers(limitcoord, dsps)
+                logger.debug('Computing mask coordinates')
 
-            logger.debug(
-                f'Saving patches for {self.imageID} patchsize: {patchsize}'
-            )
+                assert (dscentercoords[-1] < mask.shape).all()
 
-            N = len(mask_centers)
-            logger.debug('Retrieving tiles')
+                mask_centers = dscentercoords[
+                    mask[dscentercoords[:, 0], dscentercoords[:, 1]] == 1
+                ]
+                tile_generator = tilesource.get_generator(patchsize)
 
-            assert (mask_centers[-1] * downsample) / patchsize <\
-                Coord(*tile_generator.level_tiles[-1])
+                logger.debug(
+                    f'Saving patches for {self.imageID} '
+                    f'patchsize: {patchsize}'
+                )
 
-            valid_coords = []
-            for (i, coord) in tqdm(list(enumerate(mask_centers))):
-                tile = np.array(
-                    tile_generator.get_tile(
-                        level_count, (
-                            (downsample * coord.x) / patchsize,
-                            (downsample * coord.y) / patchsize)
+                N = len(mask_centers)
+                if N == 0:
+                    logger.debug(
+                        f'No tissue centers for patchsize {patchsize}'
                     )
-                )
-                if ((tile > T_otsu).sum() / np.prod(tile.shape)) < 0.25:
-                    valid_coords.append(coord)
-            n = len(valid_coords)
-            valid_coords = np.array(
-                [c.to_array() for c in valid_coords]
-            )
-            logger.debug((
-                f"Selected {n} tiles out of {N} ({n/N:0.2})"
-                "with percent whitespace < 0.25"
-            ))
-            if n > 0:
-                carray = patchcoordsfile.create_carray(
-                    '/', f'Size{patchsize}', atom,
-                    (n, 2)
-                )
-                carray[:, :] = valid_coords
-        patchcoordsfile.close()
+                    patchcoords[patchsize] = mask_centers
+                    continue
+                assert (
+                    (CoordArray.from_array(mask_centers) * downsample) /
+                    patchsize < Coord(*tile_generator.level_tiles[-1])
+                ).all()
+
+                if method == 'fast':
+                    estimates = window_means(
+                        whitespace_integral, mask_centers, dsps
+                    )
+                    valid = estimates < 0.25
+                    verify = np.flatnonzero(
+                        np.abs(estimates - 0.25) < verify_band
+                    )
+                else:
+                    valid = np.zeros(N, dtype=bool)
+                    verify = np.arange(N)
+
+                logger.debug(f'Retrieving {len(verify)} tiles')
+                centers = CoordArray.from_array(mask_centers)
+                for i in tqdm(verify):
+                    tile = np.array(
+                        tilesource.get_tile(patchsize, centers[i])
+                    )
+                    valid[i] = ((tile > T_otsu).sum() / tile.size) < 0.25
+                patchcoords[patchsize] = mask_centers[valid]
+                n = valid.sum()
+                logger.debug((
+                    f"Selected {n} tiles out of {N} ({n/N:0.2})"
+                    "with percent whitespace < 0.25"
+                ))
+
+        filters = Filters(complib='zlib', complevel=5)
+        atom = Atom.from_dtype(np.dtype('uint16'))
+        patchcoordsfile = open_file(
+            self.patchcoordsfilepath, mode='w',
+            title=f'{self.imageID} patches',
+            filters=filters
+        )
+        try:
+            for patchsize, valid_coords in patchcoords.items():
+                n = len(valid_coords)
+                if n > 0:
+                    carray = patchcoordsfile.create_carray(
+                        '/', f'Size{patchsize}', atom,
+                        (n, 2)
+                    )
+                    carray[:, :] = valid_coords
+        finally:
+            patchcoordsfile.close()
+        self.close_slide()
         return True
 
-    def get_patches(self, s, n):
-        """Generate a set of patches with size s and of length n"""
+    def get_patchcoords(self, s):
+        """Read the (n, 2) array of downsampled patch coords of size s"""
         patchcoordsfile = self.get_patchcoordsfile()\
             if not self.patchcoordsfile else self.patchcoordsfile
-        coords = [
-            Coord(*c) for c in patchcoordsfile.get_node(
-                f'/Size{s}'
-            ).read()
+        coords = patchcoordsfile.get_node(f'/Size{s}').read()
+        if not self.patchcoordsfile:
+            patchcoordsfile.close()
+        return coords
+
+    def get_patches(self, s, n, seed=None):
+        """
+        Generate a set of uint8 patches with size s and of length n. With a
+        seed, the patches are those a SamplePlan with that seed would
+        sample from this image, otherwise they are drawn from the global
+        numpy random state.
+        """
+        coords = self.get_patchcoords(s)
+        if seed is None:
+            idx = np.random.choice(len(coords), n, replace=len(coords) < n)
+        else:
+            idx = draw_indices(len(coords), n, seed, self.imageID)
+        patches = self.get_patches_batch(coords[idx], s)
+        return patches
+
+    def get_patches_batch(self, coords, s, block_size=1024):
+        """
+        Read the uint8 patches of size s at an (n, 2) array of downsampled
+        coords, with one read_region per block of nearby patches.
+        """
+        tilesource = self.get_tilesource()
+        return tilesource.read_patches(coords, s, block_size)
+
+
+def grid_centers(limitcoord, dsps):
+    """
+    Centers of a grid of downsampled patches of size dsps, as an (n, 2)
+    array of (x, y) indices in row-major (x, then y) order.
+    """
+    offsets = (dsps / 2 + np.arange(
+        max(limitcoord.x, limitcoord.y) - 1
+    ) * dsps).astype(int)
+    xs, ys = np.meshgrid(
+        offsets[:limitcoord.x - 1], offsets[:limitcoord.y - 1],
+        indexing='ij'
+    )
+    return np.stack([xs.ravel(), ys.ravel()], axis=1)
+
+
+def integral_image(region):
+    """Summed area table of a 2D array, zero padded on the leading edges"""
+    integral = np.zeros(
+        (region.shape[0] + 1, region.shape[1] + 1), dtype=np.float64
+    )
+    integral[1:, 1:] = region.cumsum(0).cumsum(1)
+    return integral
+
+
+def window_means(integral, corners, size):
+    """
+    Mean of the region under each size x size window whose top left
+    corner is given by corners, clipped to the region bounds.
+    """
+    limit = np.array(integral.shape) - 1
+    x0, y0 = corners[:, 0], corners[:, 1]
+    x1 = np.minimum(x0 + size, limit[0])
+    y1 = np.minimum(y0 + size, limit[1])
+    total = (
+        integral[x1, y1] - integral[x0, y1] -
+        integral[x1, y0] + integral[x0, y0]
+    )
+    return total / ((x1 - x0) * (y1 - y0))
+
+
+def multiscale_patchcoords(slide, mask, T_otsu, sizes):
+    """
+    Select aligned patches of every size in sizes from a single pass over
+    the full resolution slide. Each block of the largest size is read once,
+    whitespace is counted per cell of the smallest size and summed up to
+    the larger sizes. Returns downsampled coordinates per patch size.
+    """
+    base, block = min(sizes), max(sizes)
+    assert all(block % s == 0 and s % base == 0 for s in sizes)
+    downsample = slide.level_downsamples[-1]
+    dims = np.array(slide.level_dimensions[0])
+
+    candidates = {}
+    for s in sizes:
+        ncells = dims // s
+        centers = [
+            np.minimum(
+                ((np.arange(n) * s + s / 2) / downsample).astype(int),
+                limit - 1
+            )
+            for (n, limit) in zip(ncells, mask.shape)
         ]
-        replace = len(coords) < n
-        coords_choice = np.random.choice(coords, n, replace=replace)
-        slide = self.get_slide()
-        patches = generate_patches(slide, coords_choice, s)
+        candidates[s] = mask[np.ix_(*centers)] == 1
+
+    nblocks = -(-dims // block)
+    blocks = np.zeros(nblocks, dtype=bool)
+    for s in sizes:
+        f = block // s
+        padded = np.zeros(nblocks * f, dtype=bool)
+        padded[:candidates[s].shape[0], :candidates[s].shape[1]] = \
+            candidates[s]
+        blocks |= padded.reshape(
+            nblocks[0], f, nblocks[1], f
+        ).any(axis=(1, 3))
+
+    base_counts = np.full(dims // base, np.nan)
+    for (bx, by) in tqdm(np.argwhere(blocks)):
+        x0, y0 = bx * block, by * block
+        w, h = np.minimum(block, dims - (x0, y0))
+        region = np.array(
+            slide.read_region((int(x0), int(y0)), 0, (int(w), int(h)))
+        )
+        region[region[:, :, 3] == 0] = 255
+        region = region[:, :, :3].transpose(1, 0, 2)
+        cw, ch = w // base, h // base
+        whitespace = (region[:cw * base, :ch * base] > T_otsu).sum(axis=2)
+        base_counts[
+            x0 // base: x0 // base + cw, y0 // base: y0 // base + ch
+        ] = whitespace.reshape(cw, base, ch, base).sum(axis=(1, 3))
+
+    patchcoords = {}
+    for s in sizes:
+        f = s // base
+        nx, ny = candidates[s].shape
+        counts = base_counts[:nx * f, :ny * f].reshape(
+            nx, f, ny, f
+        ).sum(axis=(1, 3))
+        with np.errstate(invalid='ignore'):
+            valid = candidates[s] & (counts / (s * s * 3) < 0.25)
+        logger.debug((
+            f"Selected {valid.sum()} tiles out of {candidates[s].sum()} "
+            f"with percent whitespace < 0.25 at patchsize {s}"
+        ))
+        patchcoords[s] = np.round(
+            np.argwhere(valid) * s / downsample
+        ).astype(int)
+    return patchcoords
+
+
+class TileSource():
+    """
+    Wraps an open slide and keeps one DeepZoomGenerator per patch size,
+    so the tile pyramid is only computed once per (slide, patch size).
+    """
+
+    def __init__(self, slide):
+        self.slide = slide
+        self.downsample = slide.level_downsamples[-1]
+        self.generators = {}
+
+    def __repr__(self):
+        return f"<TileSource:{sorted(self.generators)}>"
+
+    def get_generator(self, s):
+        if s not in self.generators:
+            logger.debug(f'Building DeepZoomGenerator for patchsize {s}')
+            self.generators[s] = DeepZoomGenerator(
+                self.slide, tile_size=s, overlap=0, limit_bounds=False
+            )
+        return self.generators[s]
+
+    def get_tile(self, s, coord):
+        """Read the full resolution tile of size s at downsampled coord"""
+        tile_generator = self.get_generator(s)
+        return tile_generator.get_tile(
+            tile_generator.level_count - 1, (
+                (self.downsample * coord.x) / s,
+                (self.downsample * coord.y) / s)
+        )
+
+    def read_patches(self, coords, s, block_size=1024):
+        """
+        Read the full resolution patches of size s at an (n, 2) array of
+        downsampled coords as uint8. Coords are grouped into blocks of
+        block_size pixels, each block is read with a single read_region
+        over the bounding box of its patches and the patches are sliced
+        out of it.
+        """
+        n = len(coords)
+        patches = np.zeros((n, s, s, 3), dtype=np.uint8)
+        if n == 0:
+            return patches
+        corners = (self.downsample * np.asarray(coords)).astype(int)
+        _, blocks = np.unique(
+            corners // block_size, axis=0, return_inverse=True
+        )
+        order = np.argsort(blocks.ravel(), kind='stable')
+        groups = np.split(
+            order, np.flatnonzero(np.diff(blocks.ravel()[order])) + 1
+        )
+        for group in groups:
+            x0, y0 = corners[group].min(axis=0)
+            x1, y1 = corners[group].max(axis=0) + s
+            region = np.array(self.slide.read_region(
+                (int(x0), int(y0)), 0, (int(x1 - x0), int(y1 - y0))
+            ))
+            region[region[:, :, 3] == 0] = 255
+            for i in group:
+                x, y = corners[i] - (x0, y0)
+                patches[i] = region[y:y + s, x:x + s, :3]
         return patches
 
+    def close(self):
+        self.generators.clear()
+        self.slide.close()
+
 
-def generate_patches(slide, coords, s):
+def generate_patches(tilesource, coords, s):
 
     n = len(coords)
     patches = np.zeros((n, s, s, 3), dtype=np.float16)
-    downsample = slide.level_downsamples[-1]
 
     for (i, coord) in enumerate(coords):
-        tile_generator = DeepZoomGenerator(
-            slide, tile_size=s, overlap=0, limit_bounds=False
-        )
-        level_count = tile_generator.level_count - 1
-        tile = tile_generator.get_tile(
-            level_count, (
-                (downsample * coord.x) / s,
-                (downsample * coord.y) / s)
-        )
+        tile = tilesource.get_tile(s, coord)
         patch = np.array(tile)
         ppatch = process(patch)
         patches[i, :, :, :] = ppatch
@@ -229,19 +453,22 @@ def generate_patches(slide, coords, s):
 
 
 def process(image):
-    s = image.shape[0]
-    pimage = np.reshape(image, (1, s, s, 3))
+    """Invert and scale uint8 patches to float16 in [0, 1]"""
+    pimage = np.reshape(image, (-1,) + image.shape[-3:])
     pimage = ((255 - pimage) / 255).astype(np.float16)
     return pimage
 
 
 def deprocess(pimage):
-    image = np.squeeze(pimage)
-    image = 255 - (image * 255).astype(np.uint8)
+    """Invert process() on a patch or a batch of patches, as uint8"""
+    image = np.squeeze(pimage).astype(np.float32)
+    image = 255 - np.clip(np.round(image * 255), 0, 255).astype(np.uint8)
     return image
 
 
 class Coord():
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -269,7 +496,67 @@ class Coord():
         return np.array([self.x, self.y])
 
 
+class CoordArray():
+    """
+    Batch of coordinates stored as separate x and y arrays. Supports the
+    operators of Coord elementwise, so a whole grid of coordinates can be
+    scaled and bounds checked without creating a Coord per cell.
+    """
+
+    __slots__ = ('x', 'y')
+
+    def __init__(self, x, y):
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+
+    @classmethod
+    def from_array(cls, array):
+        """Build a CoordArray from an (n, 2) array of (x, y) rows"""
+        array = np.asarray(array)
+        return cls(array[:, 0], array[:, 1])
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, i):
+        if np.ndim(i) == 0 and not isinstance(i, slice):
+            return Coord(self.x[i], self.y[i])
+        return CoordArray(self.x[i], self.y[i])
+
+    def __iter__(self):
+        return (Coord(x, y) for (x, y) in zip(self.x, self.y))
+
+    def __mul__(self, other):
+        return CoordArray(
+            np.round(self.x * other).astype(int),
+            np.round(self.y * other).astype(int)
+        )
+
+    def __truediv__(self, other):
+        assert other != 0
+        return CoordArray(
+            np.round(self.x / other).astype(int),
+            np.round(self.y / other).astype(int)
+        )
+
+    def __repr__(self):
+        return f"<CoordArray:{len(self)}>"
+
+    def __lt__(self, other):
+        """Boolean array of which coordinates are below other in x and y"""
+        return (self.x < other.x) & (self.y < other.y)
+
+    def to_array(self):
+        return np.stack([self.x, self.y], axis=1)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.to_array()
+        return array if dtype is None else array.astype(dtype)
+
+
 class ID():
+    __slots__ = ('GTEx_ID', 'donor', 'sample', 'aliquot')
+
     def __init__(self, GTEx_ID):
         split = GTEx_ID.split('-')
         if GTEx_ID.startswith('K-562'):
@@ -285,18 +572,53 @@ class ID():
     def __repr__(self):
         return f"ID:{self.GTEx_ID}"
 
+    @classmethod
+    def from_parts(cls, GTEx_ID, donor, sample, aliquot):
+        """Build an ID from already parsed parts, as stored in Metadata"""
+        ID = cls.__new__(cls)
+        ID.GTEx_ID = GTEx_ID
+        ID.donor = donor
+        ID.sample = sample
+        ID.aliquot = aliquot if isinstance(aliquot, str) else None
+        return ID
+
 
 class Sample():
     """
         Defines the Sample object.
     """
 
+    __slots__ = ('ID', 'imageID', 'tissue', 'annotations')
+
     def __init__(self, row):
         self.ID = ID(row['SAMPID'])
         self.imageID = f'GTEX-{self.ID.donor}-{self.ID.sample}'
         self.tissue = row['SMTSD']
         self.annotations = row['SMPTHNTS']
 
+    @classmethod
+    def from_metadata(cls, samples):
+        """
+        Build the Sample of every row of the Metadata samples table from
+        its parsed columns, without parsing each SAMPID again.
+        """
+        columns = zip(
+            samples['SAMPID'], samples['donor'], samples['sample'],
+            samples['aliquot'], samples['imageID'],
+            samples['SMTSD'], samples['SMPTHNTS']
+        )
+        objects = []
+        for (
+            SAMPID, donor, sample, aliquot, imageID, tissue, annotations
+        ) in columns:
+            obj = cls.__new__(cls)
+            obj.ID = ID.from_parts(SAMPID, donor, sample, aliquot)
+            obj.imageID = imageID
+            obj.tissue = tissue
+            obj.annotations = annotations
+            objects.append(obj)
+        return pd.Series(objects, index=samples.index)
+
     def __repr__(self):
         return (
             f"Sample:{self.tissue[:5]}|"
@@ -307,7 +629,7 @@ class Sample():
         return Image(self.imageID)
 
     def has_image(self):
-        return self.imageID in Collection.imageIDs
+        return self.imageID in Metadata.image_set
 
     def has_expression(self):
 
@@ -315,13 +637,15 @@ class Sample():
             f"GTEX-{self.ID.donor}-{self.ID.sample}-SM-{self.ID.aliquot}"
         )
 
-        return expressionID in Collection.expressionIDs
+        return expressionID in Metadata.expression_set
 
     def get_aliquots(self):
         raise NotImplementedError
 
 
 class Donor():
+    __slots__ = ('donorID',)
+
     def __init__(self, donorID):
         self.donorID = donorID
 
@@ -329,62 +653,136 @@ class Donor():
         return f"<Donor:{self.donorID}>"
 
     def get_samples(self):
-        return Annotation.samples[
-            Annotation.samples['SAMPID'].apply(
-                lambda x: ID(x).donor, 1
-            ) == self.donorID
-        ].apply(Sample, axis=1)
+        return Collection.samples.iloc[
+            Metadata.by_donor.get(self.donorID, [])
+        ]
 
     def get_genotype(self):
         raise NotImplementedError
 
 
 class Annotation():
-    samples = pd.read_csv(
-        TXT_PATH + 'GTEx_v7_Annotations_SampleAttributesDS.txt',
-        sep='\t'
-    )
-    subjects = pd.read_csv(
-        TXT_PATH + 'GTEx_v7_Annotations_SubjectPhenotypesDS.txt',
-        sep='\t'
-    )
+    @lazy_attribute
+    def samples(cls):
+        return Metadata.samples
+
+    @lazy_attribute
+    def subjects(cls):
+        return Metadata.subjects
 
 
 class Collection():
-    samples = Annotation.samples.apply(Sample, axis=1)
-    sample_imageIDs = [s.imageID for s in samples]
+    @lazy_attribute
+    def samples(cls):
+        return Sample.from_metadata(Metadata.samples)
+
+    @lazy_attribute
+    def sample_imageIDs(cls):
+        return Metadata.samples['imageID'].tolist()
 
-    with open(TXT_PATH + 'image_ids.txt') as image_file:
-        imageIDs = image_file.read().splitlines()
-        images = [Image(x) for x in imageIDs]
+    @lazy_attribute
+    def imageIDs(cls):
+        return Metadata.imageIDs
 
-    expressionIDs = pd.read_csv(
-        'txt/expressionIDs.txt', sep=','
-    ).values.flatten()
+    @lazy_attribute
+    def images(cls):
+        return [Image(x) for x in cls.imageIDs]
+
+    @lazy_attribute
+    def expressionIDs(cls):
+        return Metadata.expressionIDs
+
+    @lazy_attribute
+    def images_with_samples(cls):
+        return get_images_with_samples()
 
     @staticmethod
     def where(collection, condition):
-        selection = list(filter(condition, eval(f"Collection.{collection}")))
+        selection = list(filter(condition, getattr(Collection, collection)))
         return sorted(selection, key=lambda x: x.ID.donor)
 
+    @staticmethod
+    def query(imageID=None, tissue=None, donor=None,
+              has_image=None, has_expression=None):
+        """
+        Samples matching all of the given criteria, sorted by donor like
+        Collection.where. The imageID, tissue and donor criteria are
+        looked up in the Metadata indexes and the has_image and
+        has_expression criteria are vectorized over the sample columns.
+        """
+        samples = Metadata.samples
+        selected = np.ones(len(samples), dtype=bool)
+        for (value, index) in [
+            (imageID, Metadata.by_imageID),
+            (tissue, Metadata.by_tissue),
+            (donor, Metadata.by_donor),
+        ]:
+            if value is not None:
+                mask = np.zeros(len(samples), dtype=bool)
+                mask[index.get(value, [])] = True
+                selected &= mask
+        for (value, column) in [
+            (has_image, 'has_image'),
+            (has_expression, 'has_expression'),
+        ]:
+            if value is not None:
+                selected &= samples[column].values == value
+
+        positions = np.flatnonzero(selected)
+        positions = positions[
+            np.argsort(Metadata.donor_rank[positions], kind='stable')
+        ]
+        return Collection.samples.values[positions].tolist()
+
 
 def get_images_with_samples():
-    filepath = CACHE_PATH + 'images_with_samples.py'
+    key = cache.key(
+        'images_with_samples',
+        code=[get_images_with_samples, Sample, ID],
+        files=[
+            TXT_PATH + 'GTEx_v7_Annotations_SampleAttributesDS.txt',
+            TXT_PATH + 'image_ids.txt',
+        ]
+    )
     logger.debug('Loading images with samples from cache')
-    if isfile(filepath):
-        images_with_samples = pickle.load(open(filepath, 'rb'))
-    else:
+    images_with_samples = cache.get(key)
+    if images_with_samples is None:
         logger.debug('Retrieving images_with_samples')
-        images_with_samples = []
-        for image in tqdm(Collection.images):
-            if image.has_sample():
-                sample = image.get_sample()
-                images_with_samples.append(sample)
-        pickle.dump(images_with_samples, open(filepath, 'wb'))
+        positions = [
+            Metadata.by_imageID[imageID][0]
+            for imageID in Collection.imageIDs
+            if imageID in Metadata.by_imageID
+        ]
+        images_with_samples = Collection.samples.values[positions].tolist()
+        cache.put(key, images_with_samples)
     return images_with_samples
 
 
-Collection.images_with_samples = get_images_with_samples()
+def generate_patchcoords_worker(imageID, method='tile', verify_band=0.05):
+    """
+    Generate the patch coordinates file of a single image. Runs in its own
+    process with its own slide handle and reports back a result record.
+    """
+    image = Image(imageID)
+    existed = image.has_patchcoords()
+    start = time.time()
+    error = None
+    try:
+        patchcoordsfile = image.generate_patchcoords(method, verify_band)
+        if existed:
+            patchcoordsfile.close()
+    except Exception as e:
+        logger.exception(f'Failed to generate patches for {imageID}')
+        error = repr(e)
+        image.close_slide()
+        if not existed and image.has_patchcoords():
+            os.remove(image.patchcoordsfilepath)
+    return {
+        'imageID': imageID,
+        'ok': error is None,
+        'error': error,
+        'seconds': time.time() - start,
+    }
 
 
 class Dataset():
@@ -401,12 +799,8 @@ class Dataset():
         ).most_common(n_tissues)
         self.images = {}
         for tissue, count in self.tissue_counts:
-            tissue_samples = Collection.where(
-                'samples', lambda s, tissue=tissue: (
-                    s.tissue == tissue and
-                    s.has_image() and
-                    s.has_expression()
-                )
+            tissue_samples = Collection.query(
+                tissue=tissue, has_image=True, has_expression=True
             )
             tissue_images = [
                 x.get_image() for x in tissue_samples
@@ -416,55 +810,142 @@ class Dataset():
     def __repr__(self):
         return f"<Dataset:T{self.n_tissues}-I{self.n_images}>"
 
-    def download(self):
-        for tissue, images in self.images.items():
-            logger.debug(f'Downloading {tissue} images')
-            results = [image.download() for image in images]
-            assert all(results), "Some images failed to download"
+    def download(self, workers=4, downloader=None):
+        """
+        Download every image that is not already on disk, workers at a
+        time over a shared connection pool. Returns one result per image.
+        """
+        downloader = downloader or Downloader(workers=workers)
+        targets = [
+            (image.imageID, image.imagefilepath)
+            for images in self.images.values() for image in images
+            if not image.is_downloaded()
+        ]
+        logger.debug(f'Downloading {len(targets)} images with {downloader}')
+        return downloader.download_all(targets, check=True)
 
-    def get_patchcoordfiles(self):
-        for tissue, images in self.images.items():
-            logger.debug(f'Generating patches for {tissue}')
-            results = [image.generate_patchcoords() for image in images]
-            assert all(results), "Some patches failed to generate"
+    def get_patchcoordfiles(self, workers=1, method='tile',
+                            verify_band=0.05):
+        """
+        Generate the patch coordinates file of every image, using a pool of
+        worker processes when workers > 1. Returns one result per image.
+        """
+        imageIDs = [
+            image.imageID
+            for images in self.images.values() for image in images
+        ]
+        logger.debug(
+            f'Generating patches for {len(imageIDs)} images '
+            f'with {workers} workers'
+        )
+        return run_pool(
+            generate_patchcoords_worker,
+            [(imageID, method, verify_band) for imageID in imageIDs],
+            workers, key='imageID'
+        )
 
-    def sample_data(self, patch_size, n_patches, resample=False):
+    def patch_keys(self, patch_size, n_patches, seed):
+        """Content key of the sampled patches of every image, by imageID"""
+        images = [
+            image for images in self.images.values() for image in images
+        ]
+        plan = SamplePlan.load_or_create(
+            images, patch_size, n_patches, seed
+        )
+        return plan.image_keys(
+            [image.patchcoordsfilepath for image in images]
+        )
+
+    def sample_data(self, patch_size, n_patches, resample=False, seed=None,
+                    workers=1):
+        """
+        Sample n_patches uint8 patches of patch_size from every image,
+        following the SamplePlan of the dataset for seed. Extraction is
+        sharded across a pool of worker processes when workers > 1, with
+        identical results. Returns a read-only memmap of the patches and
+        their imageIDs.
+        """
         logger.debug(f'Generating patchset for {self}')
 
-        data_filename = (
-            f'.cache/{self.n_tissues}_{self.n_images}_'
-            f'{n_patches}_{patch_size}.pkl'
+        images = [
+            image for images in self.images.values() for image in images
+        ]
+        key = cache.key(
+            'patches',
+            params={
+                'imageIDs': [image.imageID for image in images],
+                'n_patches': n_patches,
+                'patch_size': patch_size,
+            },
+            code=[Dataset.sample_data, sample_patches_worker, TileSource],
+            files=[image.patchcoordsfilepath for image in images],
+            seed=seed
         )
-        if isfile(data_filename) and not resample:
-            logger.debug(f'Loading data from cache')
-            data = joblib.load(open(data_filename, 'rb'))
-        else:
-            pbar = tqdm(total=self.n_tissues * self.n_images)
-            patches_data = np.zeros((
-                self.n_tissues * self.n_images * n_patches,
-                patch_size, patch_size, 3
-            ))
+        store = PatchStore(cache.dirpath(key))
+        if store.exists() and not resample:
+            logger.debug(f'Loading data from {store}')
+            cache.hit(key)
+            return store.open()
+
+        cache.miss(key)
+        if seed is None:
+            seed = np.random.randint(2**31)
+        plan = SamplePlan.load_or_create(
+            images, patch_size, n_patches, seed
+        )
+        try:
+            patches_data = store.create(
+                (len(plan), patch_size, patch_size, 3)
+            )
+            args = (plan.path, patches_data.filename, patches_data.shape)
+            logger.debug(f'Extracting {plan} with {workers} workers')
+            run_pool(
+                sample_patches_worker,
+                [(*args, shard, workers) for shard in range(workers)],
+                workers, key='shard'
+            )
+
+            logger.debug(f'Saving data to {store}')
+            store.commit(patches_data, plan.patch_imageIDs())
+        except BaseException:
+            store.abort()
+            raise
+        cache.added(key)
+        return store.open()
 
-            imageIDs_data = []
-            i = 0
-            for (t, tissue) in enumerate(self.images.keys()):
-                for (j, image) in enumerate(self.images[tissue]):
-                    patches = image.get_patches(patch_size, n_patches)
-                    patches_data[
-                        i * n_patches: i * n_patches + n_patches,
-                        :, :, :
-                    ] = patches
-                    imageIDs = [image.imageID] * n_patches
-                    imageIDs_data.extend(imageIDs)
-                    pbar.update(1)
-                    i += 1
-            pbar.close()
-
-            logger.debug(f'Saving data to cache')
-            data = patches_data, np.array(imageIDs_data)
-            joblib.dump(data, open(data_filename, 'wb'))
-
-        return data
+
+def sample_patches_worker(planpath, filename, shape, shard, n_shards):
+    """
+    Extract the patches of one shard of the images of a saved SamplePlan
+    into the rows of the patches memmap at filename. Runs in its own
+    process with its own slide handles and reports back a result record.
+    """
+    plan = SamplePlan.load(planpath)
+    patches_data = np.memmap(
+        filename, dtype=np.uint8, mode='r+', shape=shape
+    )
+    positions = plan.shard(shard, n_shards)
+    start = time.time()
+    error = None
+    try:
+        for k in tqdm(positions, disable=n_shards > 1):
+            image = Image(plan.imageIDs[k])
+            coords = image.get_patchcoords(plan.patch_size)
+            patches_data[plan.rows(k)] = image.get_patches_batch(
+                coords[plan.indices[k]], plan.patch_size
+            )
+            image.close_slide()
+        patches_data.flush()
+    except Exception as e:
+        logger.exception(f'Failed to extract shard {shard} of {planpath}')
+        error = repr(e)
+    return {
+        'shard': shard,
+        'ok': error is None,
+        'error': error,
+        'images': len(positions),
+        'seconds': time.time() - start,
+    }
 
 
 def train_val_split(data, split):
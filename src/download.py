@@ -0,0 +1,146 @@
+import os
+import time
+import hashlib
+import logging
+import requests
+from os.path import isfile, getsize
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from .pool import run_pool
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = 'https://brd.nci.nih.gov/brd/imagedownload/'
+CHUNK_SIZE = 4 * (2**10)**2
+
+
+class DownloadError(Exception):
+    pass
+
+
+def content_range_total(response):
+    """Total size in a Content-Range header such as bytes 0-9/100 or */100"""
+    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def md5sum(filepath, chunk_size=CHUNK_SIZE):
+    digest = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Downloader():
+    """
+    Downloads slides over a shared connection pool. Each file is streamed
+    into a .part file next to its destination, resumed with an HTTP Range
+    request if a previous attempt was interrupted, verified against the
+    expected size (and checksum, if known) and atomically renamed into
+    place once complete.
+    """
+
+    def __init__(self, base_url=BASE_URL, workers=4, chunk_size=CHUNK_SIZE,
+                 retries=3, timeout=60, checksums=None):
+        self.base_url = base_url
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.checksums = checksums or {}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers,
+            max_retries=retries
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __repr__(self):
+        return f"<Downloader:{self.base_url}|W{self.workers}>"
+
+    def download(self, imageID, filepath):
+        """Download imageID to filepath, returning the number of bytes read"""
+        partpath = filepath + '.part'
+        offset = getsize(partpath) if isfile(partpath) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        URL = self.base_url + imageID
+
+        logger.debug(f'Getting {URL} from byte {offset}')
+        restart = False
+        with self.session.get(
+            URL, headers=headers, stream=True, timeout=self.timeout
+        ) as response:
+            if response.status_code == 416 and offset:
+                expected_size = content_range_total(response)
+                restart = expected_size != offset
+                mode = None
+            elif response.status_code == 206:
+                expected_size = content_range_total(response)
+                mode = 'ab'
+            elif response.ok:
+                length = response.headers.get('Content-Length')
+                expected_size = int(length) if length else None
+                offset = 0
+                mode = 'wb'
+            else:
+                raise DownloadError(
+                    f'{URL} returned HTTP {response.status_code}'
+                )
+
+            if mode:
+                with open(partpath, mode) as outfile:
+                    response_iter = response.iter_content(
+                        chunk_size=self.chunk_size
+                    )
+                    for chunk in response_iter:
+                        outfile.write(chunk)
+
+        if restart:
+            logger.debug(
+                f'{partpath} has {offset} of {expected_size} bytes, restarting'
+            )
+            os.remove(partpath)
+            return self.download(imageID, filepath)
+
+        size = getsize(partpath)
+        if expected_size is not None and size != expected_size:
+            raise DownloadError(
+                f'{partpath} has {size} of {expected_size} bytes'
+            )
+        checksum = self.checksums.get(imageID)
+        if checksum and md5sum(partpath) != checksum:
+            os.remove(partpath)
+            raise DownloadError(f'{partpath} failed checksum verification')
+
+        os.replace(partpath, filepath)
+        logger.debug(f'Successfully downloaded {imageID}')
+        return size - offset
+
+    def download_worker(self, imageID, filepath):
+        start = time.time()
+        error = None
+        nbytes = 0
+        try:
+            nbytes = self.download(imageID, filepath)
+        except (DownloadError, requests.RequestException, OSError) as e:
+            logger.exception(f'Failed to download {imageID}')
+            error = repr(e)
+        return {
+            'imageID': imageID,
+            'ok': error is None,
+            'error': error,
+            'bytes': nbytes,
+            'seconds': time.time() - start,
+        }
+
+    def download_all(self, targets, check=False):
+        """
+        Download (imageID, filepath) targets concurrently, returning one
+        result per image. With check, failed downloads fail an assertion.
+        """
+        return run_pool(
+            self.download_worker, targets, self.workers, key='imageID',
+            executor=ThreadPoolExecutor, check=check
+        )
@@ -0,0 +1,131 @@
+import os
+import time
+import logging
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.model_selection import train_test_split, StratifiedKFold
+from sklearn.linear_model import LogisticRegression
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.svm import SVC, LinearSVC
+from sklearn.kernel_approximation import Nystroem
+from sklearn.pipeline import make_pipeline
+
+logger = logging.getLogger(__name__)
+
+RESULTS_PATH = 'results/'
+# Above this many training samples kernel='auto' approximates the SVM
+EXACT_KERNEL_LIMIT = 10000
+
+
+def make_classifiers(kernel='exact', n_jobs=1, n_components=500,
+                     random_state=42):
+    """
+    The LR, SVM and RF classifiers. kernel='exact' uses an RBF SVC with
+    probability calibration, which is quadratic or worse in the number of
+    samples. kernel='nystroem' approximates the RBF kernel with
+    n_components Nystroem features and a LinearSVC, and kernel='linear'
+    uses a LinearSVC on the features directly.
+    """
+    assert kernel in ('exact', 'nystroem', 'linear'), \
+        f'Unknown kernel {kernel}'
+    if kernel == 'exact':
+        svm = SVC(probability=True)
+    elif kernel == 'nystroem':
+        svm = make_pipeline(
+            Nystroem(n_components=n_components, random_state=random_state),
+            LinearSVC()
+        )
+    else:
+        svm = LinearSVC()
+    return {
+        'LR': LogisticRegression(),
+        'SVM': svm,
+        'RF': RandomForestClassifier(
+            n_jobs=n_jobs, random_state=random_state
+        ),
+    }
+
+
+def make_splits(y, folds=1, test_size=0.25, random_state=42):
+    """
+    Stratified (train, test) index pairs: a single split of test_size
+    when folds is 1, otherwise shuffled stratified k-fold.
+    """
+    if folds == 1:
+        return [train_test_split(
+            np.arange(len(y)), stratify=y,
+            test_size=test_size, random_state=random_state
+        )]
+    kfold = StratifiedKFold(
+        n_splits=folds, shuffle=True, random_state=random_state
+    )
+    return list(kfold.split(np.zeros(len(y)), y))
+
+
+def fit_and_score(name, estimator, X, y, train, test, fold):
+    start = time.time()
+    estimator.fit(X[train], y[train])
+    fit_seconds = time.time() - start
+    start = time.time()
+    score = estimator.score(X[test], y[test])
+    return estimator, {
+        'model': name,
+        'fold': fold,
+        'accuracy': score,
+        'fit_seconds': fit_seconds,
+        'score_seconds': time.time() - start,
+        'n_train': len(train),
+        'n_test': len(test),
+    }
+
+
+def evaluate(X, y, kernel='auto', folds=1, workers=-1, test_size=0.25,
+             random_state=42):
+    """
+    Fit and score every classifier on every split concurrently across a
+    pool of worker processes. Estimators are single threaded when the
+    pool runs several fits at once, and use every core otherwise.
+    Returns the fitted estimators by (model, fold) and one result record
+    per fit.
+    """
+    X = np.asarray(X)
+    y = np.asarray(y)
+    splits = make_splits(y, folds, test_size, random_state)
+    if kernel == 'auto':
+        kernel = 'exact' if len(splits[0][0]) <= EXACT_KERNEL_LIMIT \
+            else 'nystroem'
+    n_jobs = -1 if workers == 1 else 1
+    tasks = [
+        (name, estimator, fold)
+        for (fold, _) in enumerate(splits)
+        for (name, estimator) in make_classifiers(
+            kernel, n_jobs, random_state=random_state
+        ).items()
+    ]
+    logger.debug(
+        f'Evaluating {len(tasks)} fits with kernel={kernel} '
+        f'and {workers} workers'
+    )
+    outputs = Parallel(n_jobs=workers, backend='loky')(
+        delayed(fit_and_score)(
+            name, estimator, X, y, *splits[fold], fold
+        )
+        for (name, estimator, fold) in tasks
+    )
+    estimators = {}
+    records = []
+    for ((name, _, fold), (estimator, record)) in zip(tasks, outputs):
+        record['kernel'] = kernel
+        estimators[(name, fold)] = estimator
+        records.append(record)
+    return estimators, records
+
+
+def save_results(records, filepath):
+    """Write result records to a CSV file, returning them as a DataFrame"""
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    results = pd.DataFrame(records)
+    results.to_csv(filepath, index=False)
+    logger.debug(f'Saved {len(results)} results to {filepath}')
+    return results
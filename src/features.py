@@ -0,0 +1,188 @@
+import os
+import logging
+import numpy as np
+from tqdm import tqdm
+from tables import open_file, Filters, Float32Atom, StringAtom
+from keras.layers import Dense
+from keras.models import Model, load_model
+from .classes import process
+from .download import md5sum
+from .models import BOTTLENECK_LAYERS
+
+logger = logging.getLogger(__name__)
+
+FEATURE_PATH = 'data/features/'
+
+
+def find_bottleneck(model):
+    """
+    The encoder's bottleneck layer, found by name. Models saved before
+    the layers were named fall back to their first Dense layer, which is
+    the bottleneck of both autoencoders.
+    """
+    for layer in model.layers:
+        if layer.name in BOTTLENECK_LAYERS:
+            return layer
+    dense = [layer for layer in model.layers if isinstance(layer, Dense)]
+    assert dense, 'Model has no Dense bottleneck layer'
+    logger.debug(f'No named bottleneck, using {dense[0].name}')
+    return dense[0]
+
+
+def group_positions(imageIDs):
+    """Unique imageIDs and the positions of each, in order"""
+    unique, inverse = np.unique(imageIDs, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    counts = np.bincount(inverse, minlength=len(unique))
+    return unique, np.split(order, np.cumsum(counts)[:-1])
+
+
+class FeatureExtractor():
+    """
+    Encodes patches with the bottleneck of a saved autoencoder into a
+    chunked HDF5 store per (model file hash, patch set), the patch set
+    naming the sampling parameters. The store holds the features of
+    every patch and the imageID and content key of the patches of every
+    row, with the rows of each image contiguous. Images already in the
+    store under the same key are read back instead of encoded again,
+    their patches matched to stored rows in the order they appear, so
+    extending a dataset only encodes its new images and an image whose
+    patches changed is encoded again. Patches are streamed through the
+    encoder in batches.
+    """
+
+    def __init__(self, model_file, batch_size=256):
+        self.model_file = model_file
+        self.batch_size = batch_size
+        self.model_hash = md5sum(model_file)
+        self.encoder = None
+
+    def __repr__(self):
+        return (
+            f"<FeatureExtractor:{self.model_hash[:8]}|B{self.batch_size}>"
+        )
+
+    def get_encoder(self):
+        if self.encoder is None:
+            logger.debug(f'Loading encoder of {self.model_file}')
+            model = load_model(self.model_file, compile=False)
+            self.encoder = Model(
+                model.inputs[0], find_bottleneck(model).output
+            )
+        return self.encoder
+
+    def store_path(self, patch_set):
+        return FEATURE_PATH + f'{self.model_hash[:16]}_{patch_set}.hdf5'
+
+    def open_store(self, patch_set, dim=None):
+        """Open the feature store of patch_set, creating it given dim"""
+        path = self.store_path(patch_set)
+        if os.path.isfile(path):
+            return open_file(path, mode='a')
+        assert dim, f'{path} does not exist'
+        os.makedirs(FEATURE_PATH, exist_ok=True)
+        store = open_file(
+            path, mode='w', title=f'{self.model_file} {patch_set}',
+            filters=Filters(complib='zlib', complevel=5)
+        )
+        store.create_earray(
+            '/', 'features', Float32Atom(), (0, dim),
+            chunkshape=(self.batch_size, dim)
+        )
+        store.create_earray(
+            '/', 'imageIDs', StringAtom(itemsize=64), (0,),
+            chunkshape=(self.batch_size,)
+        )
+        store.create_earray(
+            '/', 'keys', StringAtom(itemsize=16), (0,),
+            chunkshape=(self.batch_size,)
+        )
+        store.root._v_attrs.model_file = self.model_file
+        store.root._v_attrs.model_hash = self.model_hash
+        return store
+
+    def stored_rows(self, store):
+        """Start row and number of rows of each (imageID, key) in the store"""
+        imageIDs = store.root.imageIDs.read().astype(str)
+        keys = store.root.keys.read().astype(str)
+        unique, positions = group_positions(
+            np.char.add(np.char.add(imageIDs, ':'), keys)
+        )
+        return {
+            (imageIDs[rows[0]], keys[rows[0]]): (rows[0], len(rows))
+            for rows in positions
+        }
+
+    def encode(self, store, patch_set, patches, positions, imageIDs,
+               keys):
+        """
+        Append the features of the patches at positions, their imageIDs
+        and the keys of their images to the store, one batch at a time.
+        """
+        encoder = self.get_encoder()
+        for i in tqdm(range(0, len(positions), self.batch_size)):
+            batch = positions[i:i + self.batch_size]
+            # Sorted reads keep memmap access sequential
+            order = np.argsort(batch, kind='stable')
+            features = np.zeros(
+                (len(batch), encoder.output_shape[-1]), dtype=np.float32
+            )
+            features[order] = encoder.predict(
+                process(np.asarray(patches[batch[order]]))
+            )
+            if store is None:
+                store = self.open_store(patch_set, features.shape[1])
+            store.root.features.append(features)
+            store.root.imageIDs.append(imageIDs[batch].astype('S64'))
+            store.root.keys.append(keys[batch].astype('S16'))
+        return store
+
+    def extract(self, patches, imageIDs, patch_set, image_keys):
+        """
+        Features of every patch, given the imageID of every patch, the
+        name of the patch set they were sampled in and the content key
+        of the patches of every image, encoding only the images missing
+        from the store under their key.
+        """
+        imageIDs = np.asarray(imageIDs).astype(str)
+        unique, positions = group_positions(imageIDs)
+        keys = np.array([image_keys[imageID] for imageID in imageIDs])
+
+        path = self.store_path(patch_set)
+        store = self.open_store(patch_set) if os.path.isfile(path) else None
+        if store is not None and 'keys' not in store.root:
+            logger.debug(f'Recreating {path}, written without keys')
+            store.close()
+            os.remove(path)
+            store = None
+        stored = self.stored_rows(store) if store is not None else {}
+        new = [
+            (imageID, rows) for (imageID, rows) in zip(unique, positions)
+            if (imageID, image_keys[imageID]) not in stored
+        ]
+        logger.debug(
+            f'{self}: {len(unique) - len(new)} images stored in {path}, '
+            f'encoding {len(new)}'
+        )
+        if new:
+            start = store.root.features.nrows if store is not None else 0
+            store = self.encode(
+                store, patch_set, patches,
+                np.concatenate([rows for (_, rows) in new]), imageIDs, keys
+            )
+            for (imageID, rows) in new:
+                stored[(imageID, image_keys[imageID])] = (start, len(rows))
+                start += len(rows)
+        if store is None:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        features = np.zeros(
+            (len(imageIDs), store.root.features.shape[1]), dtype=np.float32
+        )
+        for (imageID, rows) in zip(unique, positions):
+            start, count = stored[(imageID, image_keys[imageID])]
+            assert count == len(rows), \
+                f'{imageID} has {count} stored patches, not {len(rows)}'
+            features[rows] = store.root.features[start:start + count]
+        store.close()
+        return features
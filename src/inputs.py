@@ -0,0 +1,322 @@
+from keras.utils import Sequence
+from keras import backend as K
+import numpy as np
+import logging
+import threading
+from queue import Queue, Full
+from collections import OrderedDict
+from .classes import Image, process
+
+logger = logging.getLogger(__name__)
+
+
+def augment_batch(batch, random=np.random, rotate=True):
+    """
+    Random horizontal and vertical flips, and with rotate transpositions,
+    of a batch of (n, s, s, 3) patches. Flips and transposition together
+    give all 8 flips and 90 degree rotations of a square patch. Each
+    patch draws one of them, and the patches drawing the same one are
+    transformed together, so a batch takes at most 8 array operations.
+    """
+    n_transforms = 8 if rotate else 4
+    assert not rotate or batch.shape[1] == batch.shape[2], \
+        'Rotations need square patches'
+    transforms = random.randint(n_transforms, size=len(batch))
+    augmented = np.empty_like(batch)
+    # Moving whole pixels rather than single channel values is much faster
+    pixel = np.dtype((np.void, batch.shape[-1] * batch.itemsize))
+    source = np.ascontiguousarray(batch).view(pixel)[..., 0]
+    target = augmented.view(pixel)[..., 0]
+    for t in range(n_transforms):
+        idx = np.flatnonzero(transforms == t)
+        if not len(idx):
+            continue
+        x = source[idx]
+        if t & 1:
+            x = x[:, :, ::-1]
+        if t & 2:
+            x = x[:, ::-1]
+        if t & 4:
+            x = x.transpose(0, 2, 1)
+        target[idx] = x
+    return augmented
+
+
+class PatchSequence(Sequence):
+    """
+    Shuffled batches of (x, x) pairs from an array of uint8 patches, such
+    as the memmap returned by Dataset.sample_data. Patches stay uint8 in
+    memory and are augmented and normalized one batch at a time.
+    """
+
+    def __init__(self, patches_data, batch_size, augment=True, shuffle=True):
+        self.patches_data = patches_data
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augment = augment
+        self.index = np.arange(len(patches_data))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.patches_data) / self.batch_size))
+
+    def __getitem__(self, i):
+        # Sorted indices keep memmap reads sequential within a batch
+        idx = np.sort(
+            self.index[i * self.batch_size: (i + 1) * self.batch_size]
+        )
+        batch = np.asarray(self.patches_data[idx])
+        if self.augment:
+            batch = augment_batch(batch)
+        x = process(batch).astype(K.floatx())
+        return x, x
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.index)
+
+    @property
+    def steps_per_epoch(self):
+        return len(self)
+
+    @property
+    def workers(self):
+        return 1
+
+    def preview(self, n):
+        return process(self.patches_data[:n])
+
+
+class ArrayPatchSource():
+    """
+    Chunks of consecutive patches from a shuffled permutation of an array
+    of uint8 patches, such as the memmap returned by Dataset.sample_data.
+    """
+
+    def __init__(self, patches_data, chunk_size=256, seed=None):
+        self.patches_data = patches_data
+        self.chunk_size = chunk_size
+        self.random = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+        self.index = self.random.permutation(len(patches_data))
+        self.position = 0
+
+    def __len__(self):
+        return len(self.patches_data)
+
+    @property
+    def patch_size(self):
+        return self.patches_data.shape[1]
+
+    def next_indices(self):
+        with self.lock:
+            if self.position >= len(self.index):
+                # A new permutation, as chunks handed out are views of
+                # the previous one
+                self.index = self.random.permutation(len(self.index))
+                self.position = 0
+            indices = self.index[
+                self.position: self.position + self.chunk_size
+            ]
+            self.position += self.chunk_size
+        return indices
+
+    def read(self, indices, state):
+        return np.asarray(self.patches_data[np.sort(indices)])
+
+    def preview(self, n):
+        return np.asarray(self.patches_data[:n])
+
+
+class SlidePatchSource():
+    """
+    Chunks of patches read directly from the slides, using the patch
+    coordinates files of the given images. Each chunk holds chunk_size
+    random patches of one random image. An epoch nominally holds
+    n_patches patches per image.
+    """
+
+    def __init__(self, images, patch_size, n_patches=100, chunk_size=32,
+                 max_open=8, seed=None):
+        self.patch_size = patch_size
+        self.n_patches = n_patches
+        self.chunk_size = chunk_size
+        self.max_open = max_open
+        self.random = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+
+        self.imageIDs = []
+        self.coords = []
+        for image in images:
+            patchcoordsfile = image.get_patchcoordsfile()
+            node = f'/Size{patch_size}'
+            if node in patchcoordsfile:
+                self.imageIDs.append(image.imageID)
+                self.coords.append(patchcoordsfile.get_node(node).read())
+            else:
+                logger.debug(f'{image} has no patches of size {patch_size}')
+            patchcoordsfile.close()
+        assert self.imageIDs, f'No images with patches of size {patch_size}'
+
+    def __len__(self):
+        return len(self.imageIDs) * self.n_patches
+
+    def next_indices(self):
+        with self.lock:
+            i = self.random.randint(len(self.imageIDs))
+            coords_idx = self.random.randint(
+                len(self.coords[i]), size=self.chunk_size
+            )
+        return i, coords_idx
+
+    def read(self, indices, state):
+        """
+        Read a chunk with the worker's own slide handles. state is the
+        worker's LRU of open images, closed when they are evicted.
+        """
+        i, coords_idx = indices
+        if i in state:
+            state.move_to_end(i)
+        else:
+            state[i] = Image(self.imageIDs[i])
+            while len(state) > self.max_open:
+                _, image = state.popitem(last=False)
+                image.close_slide()
+        return state[i].get_patches_batch(
+            self.coords[i][np.sort(coords_idx)], self.patch_size
+        )
+
+    def preview(self, n):
+        image = Image(self.imageIDs[0])
+        patches = image.get_patches_batch(self.coords[0][:n], self.patch_size)
+        image.close_slide()
+        return patches
+
+
+class PatchStream():
+    """
+    Endless shuffled batches of (x, x) pairs streamed from a patch source.
+    Background worker threads read and augment chunks of uint8 patches
+    into a bounded prefetch queue, and batches are drawn at random from a
+    fixed size shuffle buffer of those chunks, so memory stays constant
+    however large the dataset is.
+    """
+
+    def __init__(self, source, batch_size, workers=4, prefetch=16,
+                 buffer_size=1024, augment=True, seed=None):
+        self.source = source
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        assert buffer_size >= batch_size
+        self.random = np.random.RandomState(seed)
+        self.augment = augment
+
+        s = source.patch_size
+        self.buffer = np.zeros((buffer_size, s, s, 3), dtype=np.uint8)
+        self.buffered = 0
+        self.pending = np.zeros((0, s, s, 3), dtype=np.uint8)
+
+        self.queue = Queue(maxsize=prefetch)
+        self.stopped = threading.Event()
+        self.threads = [
+            threading.Thread(
+                target=self.work, args=(self.random.randint(2**31),),
+                daemon=True
+            )
+            for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def __repr__(self):
+        return f"<PatchStream:{len(self.source)}x{self.source.patch_size}>"
+
+    @property
+    def shape(self):
+        s = self.source.patch_size
+        return (len(self.source), s, s, 3)
+
+    @property
+    def steps_per_epoch(self):
+        return int(np.ceil(len(self.source) / self.batch_size))
+
+    @property
+    def workers(self):
+        # Batches are already prefetched by the stream's own threads
+        return 0
+
+    def put(self, item):
+        """Queue item, giving up once the stream is closed"""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                break
+            except Full:
+                pass
+
+    def work(self, seed):
+        state = OrderedDict()
+        random = np.random.RandomState(seed)
+        try:
+            while not self.stopped.is_set():
+                chunk = self.source.read(self.source.next_indices(), state)
+                if self.augment:
+                    chunk = augment_batch(chunk, random)
+                self.put(chunk)
+        except Exception as e:
+            logger.exception('PatchStream worker failed')
+            self.put(e)
+        finally:
+            for image in state.values():
+                image.close_slide()
+
+    def fill(self):
+        """Top up the shuffle buffer from the prefetch queue"""
+        while self.buffered < self.buffer_size:
+            if not len(self.pending):
+                chunk = self.queue.get()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                self.pending = chunk
+            n = min(len(self.pending), self.buffer_size - self.buffered)
+            self.buffer[self.buffered: self.buffered + n] = self.pending[:n]
+            self.pending = self.pending[n:]
+            self.buffered += n
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.fill()
+        idx = self.random.choice(
+            self.buffer_size, self.batch_size, replace=False
+        )
+        batch = self.buffer[idx]
+        # Drawn slots are refilled with the patches at the end of the buffer
+        keep = np.setdiff1d(
+            np.arange(self.buffer_size - self.batch_size, self.buffer_size),
+            idx
+        )
+        holes = np.setdiff1d(
+            idx, np.arange(self.buffer_size - self.batch_size,
+                           self.buffer_size)
+        )
+        self.buffer[holes] = self.buffer[keep]
+        self.buffered -= self.batch_size
+        x = process(batch).astype(K.floatx())
+        return x, x
+
+    def preview(self, n):
+        return process(self.source.preview(n))
+
+    def close(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+
+
+def as_training_input(patches_data, batch_size):
+    """Wrap an array of uint8 patches in a PatchSequence unless streaming"""
+    if isinstance(patches_data, PatchStream):
+        return patches_data
+    return PatchSequence(patches_data, batch_size)
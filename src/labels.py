@@ -0,0 +1,52 @@
+import hashlib
+import logging
+import numpy as np
+from .metadata import Metadata
+
+logger = logging.getLogger(__name__)
+
+
+class PatchLabels():
+    """
+    Labels of every patch of a patch set, given the imageID of each patch.
+    The imageIDs are deduplicated once, each unique image is resolved once
+    through the Metadata indexes and the result is broadcast back to the
+    patches. The fingerprint identifies the patch set in cache keys and
+    is computed once.
+    """
+
+    def __init__(self, imageIDs):
+        self.imageIDs = np.asarray(imageIDs).astype(str)
+        self.unique, self.inverse = np.unique(
+            self.imageIDs, return_inverse=True
+        )
+        self.inverse = self.inverse.ravel()
+        digest = hashlib.sha256('\n'.join(self.unique).encode('utf-8'))
+        digest.update(self.inverse.astype(np.int64).tobytes())
+        self.fingerprint = digest.hexdigest()
+
+    def __repr__(self):
+        return f"<PatchLabels:{len(self.unique)}|N{len(self)}>"
+
+    def __len__(self):
+        return len(self.imageIDs)
+
+    def resolve(self, column):
+        """Value of a Metadata samples column for every patch"""
+        positions = []
+        for imageID in self.unique:
+            rows = Metadata.by_imageID.get(imageID)
+            assert rows is not None, f'{imageID} has no sample'
+            positions.append(rows[0])
+        values = Metadata.samples[column].values[positions]
+        return values[self.inverse]
+
+    def tissues(self):
+        return self.resolve('SMTSD')
+
+    def donors(self):
+        return self.resolve('donor')
+
+    def subset(self, idx):
+        """Labels of the patches selected by an index or mask"""
+        return PatchLabels(self.imageIDs[idx])
@@ -0,0 +1,106 @@
+import logging
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+TXT_PATH = 'txt/'
+
+
+class lazy_attribute():
+    """
+    Class attribute computed by its loader on first access, then stored on
+    the class in place of the descriptor so later accesses are plain
+    attribute lookups.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.__doc__ = loader.__doc__
+
+    def __get__(self, instance, owner):
+        logger.debug(f'Loading {owner.__name__}.{self.loader.__name__}')
+        value = self.loader(owner)
+        setattr(owner, self.loader.__name__, value)
+        return value
+
+
+class Metadata():
+    """
+    GTEx sample, subject, image and expression metadata. Each table is
+    read on first access. Samples are kept in columnar form, with the
+    donor, sample, aliquot, imageID and expressionID of every SAMPID and
+    whether it has an image and expression data derived once, and indexed
+    by imageID, donor and tissue.
+    """
+
+    @lazy_attribute
+    def samples(cls):
+        samples = pd.read_csv(
+            TXT_PATH + 'GTEx_v7_Annotations_SampleAttributesDS.txt',
+            sep='\t'
+        )
+        split = samples['SAMPID'].str.split('-')
+        k562 = samples['SAMPID'].str.startswith('K-562')
+        samples['donor'] = split.str[1].where(~k562, 'K-562')
+        samples['sample'] = split.str[2].where(~k562, 'K-562')
+        samples['imageID'] = (
+            'GTEX-' + samples['donor'] + '-' + samples['sample']
+        )
+        samples['aliquot'] = split.str[-1].where(split.str.len() == 5)
+        samples['expressionID'] = (
+            samples['imageID'] + '-SM-' + samples['aliquot']
+        )
+        samples['has_image'] = samples['imageID'].isin(cls.image_set)
+        samples['has_expression'] = samples['expressionID'].isin(
+            cls.expression_set
+        )
+        return samples
+
+    @lazy_attribute
+    def subjects(cls):
+        return pd.read_csv(
+            TXT_PATH + 'GTEx_v7_Annotations_SubjectPhenotypesDS.txt',
+            sep='\t'
+        )
+
+    @lazy_attribute
+    def imageIDs(cls):
+        with open(TXT_PATH + 'image_ids.txt') as image_file:
+            return image_file.read().splitlines()
+
+    @lazy_attribute
+    def expressionIDs(cls):
+        return pd.read_csv(
+            TXT_PATH + 'expressionIDs.txt', sep=','
+        ).values.flatten()
+
+    @lazy_attribute
+    def image_set(cls):
+        return set(cls.imageIDs)
+
+    @lazy_attribute
+    def expression_set(cls):
+        return set(cls.expressionIDs)
+
+    @lazy_attribute
+    def donor_rank(cls):
+        """Rank of each sample when stably sorted by donor"""
+        order = cls.samples['donor'].values.argsort(kind='stable')
+        rank = order.copy()
+        rank[order] = range(len(order))
+        return rank
+
+    @lazy_attribute
+    def by_imageID(cls):
+        """Row positions in samples of each imageID"""
+        return cls.samples.groupby('imageID').indices
+
+    @lazy_attribute
+    def by_donor(cls):
+        """Row positions in samples of each donor"""
+        return cls.samples.groupby('donor').indices
+
+    @lazy_attribute
+    def by_tissue(cls):
+        """Row positions in samples of each tissue"""
+        return cls.samples.groupby('SMTSD').indices
@@ -3,7 +3,6 @@ from keras.layers import (
     Input, Dense, Conv2D, MaxPooling2D,
     UpSampling2D, Flatten, Reshape, Dropout
 )
-from keras.preprocessing.image import ImageDataGenerator
 from keras.models import Model
 from keras.callbacks import (
     Callback, TensorBoard, ModelCheckpoint
@@ -17,7 +16,11 @@ import logging
 from itertools import cycle
 from tqdm import tqdm
 logger = logging.getLogger(__name__)
-from .callbacks import TensorBoardImage
+from .callbacks import TensorBoardImage, ThroughputMonitor
+from .inputs import as_training_input
+
+# Names of the bottleneck layers encoders are cut at for features
+BOTTLENECK_LAYERS = ('encoded', 'z_mean')
 
 
 class ConvolutionalAutoencoder():
@@ -57,7 +60,8 @@ class ConvolutionalAutoencoder():
 
         encoded = Dense(
             self.inner_dim,
-            activity_regularizer='l2'
+            activity_regularizer='l2',
+            name='encoded'
         )(x)
         return encoded
 
@@ -101,9 +105,12 @@ class ConvolutionalAutoencoder():
         self.name = (
             f"CA_ps{self.params['patch_size']}_"
             f"n{self.params['N']}_e{self.params['epochs']}_"
-            f"lr{self.params['lr']}_bs{self.params['batch_size']}_"
+            f"lr{self.params['lr']}_b1{self.params['beta_1']}_"
+            f"bs{self.params['batch_size']}_"
             f"dim{self.params['inner_dim']}_do{self.params['dropout_rate']}"
         )
+        if 'trial' in self.params:
+            self.name += f"_trial{self.params['trial']}"
         input_img = Input(
             shape=(
                 self.params['patch_size'],
@@ -119,6 +126,11 @@ class ConvolutionalAutoencoder():
         return model
 
     def train_on_data(self, patches_data, params):
+        """
+        Train on an array of uint8 patches, normalized batch by batch, or
+        on a PatchStream of batches streamed from disk. Returns the
+        training History.
+        """
 
         adam = Adam(
             lr=params['lr'], beta_1=params['beta_1']
@@ -131,28 +143,29 @@ class ConvolutionalAutoencoder():
             loss='mean_squared_error',
         )
 
-        datagen = ImageDataGenerator(
-            horizontal_flip=True,
-            vertical_flip=True
-        )
+        inputs = as_training_input(patches_data, params['batch_size'])
 
         logger.debug('Fitting model')
-        model.fit_generator(
-            datagen.flow(
-                patches_data, patches_data, batch_size=params['batch_size']
-            ),
-            steps_per_epoch=self.params['N'] / params['batch_size'],
+        history = model.fit_generator(
+            inputs,
+            steps_per_epoch=inputs.steps_per_epoch,
             epochs=params['epochs'],
+            workers=inputs.workers,
             callbacks=[
                 TensorBoard(
                     log_dir=(
                         f'./tensorboardlogs/{self.name}'
                     )
                 ),
-                TensorBoardImage(patches_data, self.name)
+                TensorBoardImage(
+                    inputs.preview(params.get('preview_patches', 4)),
+                    self.name, interval=params.get('image_interval', 1)
+                ),
+                ThroughputMonitor(f'./tensorboardlogs/{self.name}')
             ],
         )
         self.model = model
+        return history
 
     def save(self):
         assert self.model, "Model must be trained first"
@@ -195,8 +208,8 @@ class VariationalConvolutionalAutoencoder(object):
         if self.dropout_rate > 0:
             x = Dropout(self.dropout_rate)(x)
 
-        z_mean = Dense(self.inner_dim)(x)
-        z_log_var = Dense(self.inner_dim)(x)
+        z_mean = Dense(self.inner_dim, name='z_mean')(x)
+        z_log_var = Dense(self.inner_dim, name='z_log_var')(x)
 
         inner_dim = self.inner_dim
         epsilon_std = self.epsilon_std
@@ -259,10 +272,13 @@ class VariationalConvolutionalAutoencoder(object):
         self.name = (
             f"VCA_ps{self.params['patch_size']}_"
             f"n{self.params['N']}_e{self.params['epochs']}_"
-            f"lr{self.params['lr']}_bs{self.params['batch_size']}_"
+            f"lr{self.params['lr']}_b1{self.params['beta_1']}_"
+            f"bs{self.params['batch_size']}_"
             f"dim{self.params['inner_dim']}_do{self.params['dropout_rate']}"
             "ps*mse"
         )
+        if 'trial' in self.params:
+            self.name += f"_trial{self.params['trial']}"
         input_img = Input(
             shape=(
                 self.params['patch_size'],
@@ -278,6 +294,11 @@ class VariationalConvolutionalAutoencoder(object):
         return model
 
     def train_on_data(self, patches_data, params):
+        """
+        Train on an array of uint8 patches, normalized batch by batch, or
+        on a PatchStream of batches streamed from disk. Returns the
+        training History.
+        """
 
         # rmsprop = RMSprop(
         #     0.001, epsilon=1.0
@@ -304,32 +325,29 @@ class VariationalConvolutionalAutoencoder(object):
             optimizer=adam, loss=vae_loss
         )
 
-        datagen = ImageDataGenerator(
-            horizontal_flip=True,
-            vertical_flip=True
-        )
+        inputs = as_training_input(patches_data, params['batch_size'])
 
         logger.debug('Fitting model')
 
-
-
-
-
-        self.model.fit_generator(
-            datagen.flow(
-                patches_data, patches_data, batch_size=params['batch_size']
-            ),
-            steps_per_epoch=self.params['N'] / params['batch_size'],
+        history = self.model.fit_generator(
+            inputs,
+            steps_per_epoch=inputs.steps_per_epoch,
             epochs=params['epochs'],
+            workers=inputs.workers,
             callbacks=[
                 TensorBoard(
                     log_dir=(
                         f'./tensorboardlogs/{self.name}'
                     )
                 ),
-                TensorBoardImage(patches_data, self.name)
+                TensorBoardImage(
+                    inputs.preview(params.get('preview_patches', 4)),
+                    self.name, interval=params.get('image_interval', 1)
+                ),
+                ThroughputMonitor(f'./tensorboardlogs/{self.name}')
             ],
         )
+        return history
 
     def save(self):
         assert self.model, "Model must be trained first"
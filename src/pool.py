@@ -0,0 +1,62 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+def call(fn, args):
+    """fn(*args), reporting an exception as a failed result record"""
+    try:
+        return fn(*args)
+    except Exception as e:
+        logger.exception(f'{fn.__name__} failed')
+        return {'ok': False, 'error': repr(e), 'seconds': None}
+
+
+def run_pool(fn, tasks, workers=1, key=None, executor=ProcessPoolExecutor,
+             check=True, callback=None):
+    """
+    Call fn(*args) for every args in tasks, across a pool of workers when
+    workers > 1 and in this process otherwise. fn reports back a result
+    record with 'ok', 'error' and 'seconds', named by its key field. A
+    task whose worker died is reported as a failed record. Every record
+    is logged and passed to callback(args, record) as it completes, and
+    failures fail an assertion unless check is False. Returns the
+    records in completion order.
+    """
+    records = []
+    failures = []
+
+    def complete(args, record):
+        name = f'{key} {record[key]}' if key in record else f'{args}'
+        status = 'ok' if record['ok'] else record['error']
+        if record.get('seconds') is not None:
+            status += f" ({record['seconds']:.1f}s)"
+        logger.debug(f'{name}: {status}')
+        if not record['ok']:
+            failures.append(name)
+        if callback is not None:
+            callback(args, record)
+        records.append(record)
+
+    if workers > 1:
+        with executor(max_workers=workers) as pool:
+            futures = {pool.submit(fn, *args): args for args in tasks}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                args = futures[future]
+                try:
+                    record = future.result()
+                except Exception as e:
+                    # The worker itself died, e.g. killed for running out
+                    # of memory
+                    logger.exception(f'{fn.__name__}{args} failed')
+                    record = {'ok': False, 'error': repr(e), 'seconds': None}
+                complete(args, record)
+    else:
+        for args in tqdm(tasks):
+            complete(args, call(fn, args))
+
+    assert not check or not failures, \
+        f'Some of {fn.__name__} failed: {failures}'
+    return records
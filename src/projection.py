@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import numpy as np
+from tqdm import tqdm
+from sklearn.decomposition import PCA, IncrementalPCA, TruncatedSVD
+from sklearn.manifold import TSNE
+from .cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+def chunks(features, chunk_size):
+    """Consecutive row chunks of an array or a PyTables feature store"""
+    for i in range(0, len(features), chunk_size):
+        yield np.asarray(features[i:i + chunk_size])
+
+
+def features_digest(features, chunk_size=8192):
+    """sha256 of the values of an array or a chunked on-disk store"""
+    shape = tuple(int(n) for n in features.shape)
+    digest = hashlib.sha256(repr(shape).encode('utf-8'))
+    for chunk in chunks(features, chunk_size):
+        digest.update(np.ascontiguousarray(chunk).tobytes())
+    return digest.hexdigest()
+
+
+def project(features, n_components=3, method='randomized', chunk_size=8192,
+            random_state=42):
+    """
+    Project features onto their first n_components components.
+
+    method='randomized' computes only those components of an in-memory
+    array with a randomized SVD. method='svd' is the randomized truncated
+    SVD without centering. method='incremental' fits an IncrementalPCA
+    chunk by chunk, so features can be a chunked on-disk store (such as
+    the features EArray of a FeatureExtractor store) larger than memory.
+    Returns the projected features and the explained variance ratios.
+    """
+    assert method in ('randomized', 'svd', 'incremental'), \
+        f'Unknown method {method}'
+    logger.debug(
+        f'Projecting {len(features)} features onto {n_components} '
+        f'components with method={method}'
+    )
+    if method == 'incremental':
+        chunk_size = max(chunk_size, n_components)
+        model = IncrementalPCA(n_components=n_components)
+        for chunk in tqdm(chunks(features, chunk_size)):
+            # partial_fit needs at least n_components rows per chunk
+            if len(chunk) >= n_components:
+                model.partial_fit(chunk)
+        projected = np.concatenate([
+            model.transform(chunk) for chunk in chunks(features, chunk_size)
+        ])
+    else:
+        if method == 'randomized':
+            model = PCA(
+                n_components=n_components, svd_solver='randomized',
+                random_state=random_state
+            )
+        else:
+            model = TruncatedSVD(
+                n_components=n_components, random_state=random_state
+            )
+        projected = model.fit_transform(np.asarray(features))
+    return projected, model.explained_variance_ratio_
+
+
+def embed(features, n_samples=10000, n_pca=50, random_state=42):
+    """
+    2D t-SNE embedding of a random subsample of n_samples features, each
+    first reduced to n_pca components with a randomized PCA. Returns the
+    indices of the subsampled features and their embedding.
+    """
+    random = np.random.RandomState(random_state)
+    idx = np.arange(len(features))
+    if len(features) > n_samples:
+        idx = np.sort(random.choice(len(features), n_samples, replace=False))
+    sample = np.asarray(features[idx, :])
+    n_pca = min(n_pca, *sample.shape)
+    reduced, _ = project(sample, n_pca, random_state=random_state)
+    logger.debug(f'Embedding {len(idx)} features in 2D')
+    embedding = TSNE(
+        n_components=2, random_state=random_state
+    ).fit_transform(reduced)
+    return idx, embedding
+
+
+def cached_projection(features_ID, features, n_components=3,
+                      method='randomized'):
+    """project(), cached by the features and projection parameters"""
+    key = cache.key(
+        'projection',
+        params={
+            'features_ID': features_ID,
+            'features': features_digest(features),
+            'n_components': n_components,
+            'method': method,
+        },
+        code=[project]
+    )
+    projection = cache.get(key)
+    if projection is None:
+        projection = cache.put(
+            key, project(features, n_components, method)
+        )
+    return projection
+
+
+def cached_embedding(features_ID, features, n_samples=10000):
+    """embed(), cached by the features and sample size"""
+    key = cache.key(
+        'embedding',
+        params={
+            'features_ID': features_ID,
+            'features': features_digest(features),
+            'n_samples': n_samples,
+        },
+        code=[embed, project]
+    )
+    embedding = cache.get(key)
+    if embedding is None:
+        embedding = cache.put(key, embed(features, n_samples))
+    return embedding
@@ -0,0 +1,150 @@
+import os
+import hashlib
+import logging
+import numpy as np
+from os.path import isfile
+from .cache import cache
+
+logger = logging.getLogger(__name__)
+
+PLAN_PATH = 'data/patches/plans/'
+
+
+def image_seed(seed, imageID):
+    """Seed of an image's own RandomState, derived from the plan seed"""
+    digest = hashlib.sha256(f'{seed}:{imageID}'.encode('utf-8'))
+    return int(digest.hexdigest()[:8], 16)
+
+
+def draw_indices(n_coords, n_patches, seed, imageID):
+    """Indices of the n_patches coordinates sampled from an image"""
+    assert n_coords > 0, f'{imageID} has no patch coordinates'
+    random = np.random.RandomState(image_seed(seed, imageID))
+    return random.choice(
+        n_coords, n_patches, replace=n_coords < n_patches
+    ).astype(np.uint32)
+
+
+class SamplePlan():
+    """
+    The patches sampled from each image of a dataset, stored as an
+    (n_images, n_patches) array of indices into each image's patch
+    coordinates of patch_size. Each image's indices are drawn from its own
+    RandomState, seeded by the plan seed and its imageID, so a plan does
+    not depend on the order or number of images, and extending a dataset
+    keeps the patches of the images it already had.
+    """
+
+    def __init__(self, imageIDs, patch_size, n_patches, seed, indices):
+        self.imageIDs = np.asarray(imageIDs)
+        self.patch_size = patch_size
+        self.n_patches = n_patches
+        self.seed = seed
+        self.indices = indices
+        self.path = None
+
+    def __repr__(self):
+        return (
+            f"<SamplePlan:{len(self.imageIDs)}x{self.n_patches}|"
+            f"S{self.patch_size}|seed{self.seed}>"
+        )
+
+    def __len__(self):
+        return len(self.imageIDs) * self.n_patches
+
+    @classmethod
+    def create(cls, images, patch_size, n_patches, seed):
+        """Draw a plan from the patch coordinates files of images"""
+        indices = np.zeros((len(images), n_patches), dtype=np.uint32)
+        for (k, image) in enumerate(images):
+            patchcoordsfile = image.get_patchcoordsfile()
+            n_coords = patchcoordsfile.get_node(f'/Size{patch_size}').nrows
+            patchcoordsfile.close()
+            indices[k] = draw_indices(
+                n_coords, n_patches, seed, image.imageID
+            )
+        return cls(
+            [image.imageID for image in images], patch_size, n_patches,
+            seed, indices
+        )
+
+    @classmethod
+    def load_or_create(cls, images, patch_size, n_patches, seed):
+        """
+        Load the plan of images from PLAN_PATH, or create and save it.
+        Plans are keyed by their parameters and the patch coordinates
+        files they index into.
+        """
+        key = cache.key(
+            'plan',
+            params={
+                'imageIDs': [image.imageID for image in images],
+                'patch_size': patch_size,
+                'n_patches': n_patches,
+            },
+            code=[draw_indices, image_seed],
+            files=[image.patchcoordsfilepath for image in images],
+            seed=seed
+        )
+        path = PLAN_PATH + key + '.npz'
+        if isfile(path):
+            logger.debug(f'Loading sample plan {path}')
+            return cls.load(path)
+        plan = cls.create(images, patch_size, n_patches, seed)
+        plan.save(path)
+        return plan
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmppath = f'{path}.tmp{os.getpid()}'
+        with open(tmppath, 'wb') as f:
+            np.savez(
+                f, imageIDs=self.imageIDs, indices=self.indices,
+                params=np.array(
+                    [self.patch_size, self.n_patches, self.seed]
+                )
+            )
+        os.replace(tmppath, path)
+        self.path = path
+        logger.debug(f'Saved {self} to {path}')
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            patch_size, n_patches, seed = data['params'].tolist()
+            plan = cls(
+                data['imageIDs'], patch_size, n_patches, seed,
+                data['indices']
+            )
+        plan.path = path
+        return plan
+
+    def image_keys(self, filepaths):
+        """
+        Content key of the patches of every image, by imageID, from its
+        imageID, the size and mtime of its patch coordinates file at
+        filepaths and its indices. The key changes whenever the patches
+        sampled from the image do.
+        """
+        keys = {}
+        for (k, filepath) in enumerate(filepaths):
+            stat = os.stat(filepath)
+            digest = hashlib.sha256(
+                f'{self.imageIDs[k]}:{self.patch_size}:{stat.st_size}:'
+                f'{stat.st_mtime_ns}'.encode('utf-8')
+            )
+            digest.update(np.ascontiguousarray(self.indices[k]).tobytes())
+            keys[str(self.imageIDs[k])] = digest.hexdigest()[:16]
+        return keys
+
+    def patch_imageIDs(self):
+        """imageID of every patch, in the order the plan extracts them"""
+        return np.repeat(self.imageIDs, self.n_patches)
+
+    def shard(self, i, n_shards):
+        """Positions of the images extracted by shard i of n_shards"""
+        return np.arange(i, len(self.imageIDs), n_shards)
+
+    def rows(self, k):
+        """Rows of the patches of the image at position k"""
+        return slice(k * self.n_patches, (k + 1) * self.n_patches)
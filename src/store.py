@@ -0,0 +1,74 @@
+import os
+import json
+import shutil
+import logging
+import numpy as np
+from os.path import isfile, isdir, join
+
+logger = logging.getLogger(__name__)
+
+
+class PatchStore():
+    """
+    On-disk store of uint8 patches. A store is a directory holding the
+    patches as a raw (N, s, s, 3) uint8 array, which readers map with
+    np.memmap instead of loading into memory, and an index of the imageID
+    of every patch. Stores are written into a temporary directory and
+    renamed into place once complete, so concurrent readers only ever
+    see finished stores.
+    """
+
+    def __init__(self, path):
+        self.path = path.rstrip('/')
+        self.tmppath = f'{self.path}.tmp{os.getpid()}'
+        self.shape = None
+
+    def __repr__(self):
+        return f"<PatchStore:{self.path}>"
+
+    def exists(self):
+        return isfile(join(self.path, 'meta.json'))
+
+    def create(self, shape):
+        """Return a writable memmap of the given shape for a new store"""
+        if isdir(self.tmppath):
+            shutil.rmtree(self.tmppath)
+        os.makedirs(self.tmppath)
+        self.shape = tuple(shape)
+        return np.memmap(
+            join(self.tmppath, 'patches.u8'), dtype=np.uint8,
+            mode='w+', shape=self.shape
+        )
+
+    def abort(self):
+        """Remove the temporary directory of a store that failed"""
+        if isdir(self.tmppath):
+            shutil.rmtree(self.tmppath)
+
+    def commit(self, patches, imageIDs):
+        """Flush the patches written to create() and publish the store"""
+        assert self.shape is not None, "Store must be created first"
+        assert len(imageIDs) == self.shape[0]
+        patches.flush()
+        np.save(join(self.tmppath, 'imageIDs.npy'), np.asarray(imageIDs))
+        with open(join(self.tmppath, 'meta.json'), 'w') as f:
+            json.dump({'shape': self.shape, 'dtype': 'uint8'}, f)
+
+        oldpath = f'{self.path}.old{os.getpid()}'
+        if isdir(self.path):
+            os.rename(self.path, oldpath)
+        os.rename(self.tmppath, self.path)
+        if isdir(oldpath):
+            shutil.rmtree(oldpath)
+        logger.debug(f'Saved {self.shape[0]} patches to {self}')
+
+    def open(self):
+        """Map the patches read-only and load the imageID index"""
+        with open(join(self.path, 'meta.json')) as f:
+            meta = json.load(f)
+        patches = np.memmap(
+            join(self.path, 'patches.u8'), dtype=meta['dtype'],
+            mode='r', shape=tuple(meta['shape'])
+        )
+        imageIDs = np.load(join(self.path, 'imageIDs.npy'))
+        return patches, imageIDs
@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import itertools
+import numpy as np
+import pandas as pd
+from contextlib import closing
+from .store import PatchStore
+from .pool import run_pool
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_PATH = 'results/sweeps.sqlite'
+# Hyperparameters a sweep searches over, with their types
+SEARCH_SPACE = {
+    'inner_dim': int,
+    'lr': float,
+    'beta_1': float,
+    'batch_size': int,
+    'dropout_rate': float,
+}
+# Environment variables bounding the threads of numerical libraries
+THREAD_VARIABLES = (
+    'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'
+)
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS trials (
+    trial INTEGER PRIMARY KEY AUTOINCREMENT,
+    sweep TEXT NOT NULL,
+    model_type TEXT NOT NULL,
+    dataset TEXT,
+    inner_dim INTEGER,
+    lr REAL,
+    beta_1 REAL,
+    batch_size INTEGER,
+    dropout_rate REAL,
+    epochs INTEGER,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    name TEXT,
+    final_loss REAL,
+    best_loss REAL,
+    epochs_run INTEGER,
+    seconds REAL,
+    samples_per_second REAL,
+    threads INTEGER,
+    error TEXT,
+    created REAL,
+    finished REAL
+)
+'''
+
+
+def grid_configs(space):
+    """Every combination of the values of each hyperparameter"""
+    names = sorted(space)
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*(space[name] for name in names))
+    ]
+
+
+def random_configs(space, n_trials, seed=42, max_draws=100):
+    """
+    n_trials distinct random configurations. Hyperparameters given as a
+    list are drawn uniformly from it, those given as a (low, high) tuple
+    are drawn log-uniformly from that range. Without ranges the space is
+    a finite grid, which is sampled without replacement, so there are at
+    most as many configurations as grid points.
+    """
+    random = np.random.RandomState(seed)
+    if not any(isinstance(values, tuple) for values in space.values()):
+        grid = grid_configs(space)
+        picks = random.choice(
+            len(grid), min(n_trials, len(grid)), replace=False
+        )
+        return [grid[i] for i in picks]
+
+    configs = {}
+    for _ in range(max_draws * n_trials):
+        if len(configs) == n_trials:
+            break
+        config = {}
+        for name in sorted(space):
+            values = space[name]
+            if isinstance(values, tuple):
+                low, high = np.log(values[0]), np.log(values[1])
+                value = float(np.exp(random.uniform(low, high)))
+            else:
+                value = values[random.randint(len(values))]
+            config[name] = SEARCH_SPACE.get(name, float)(value)
+        configs.setdefault(json.dumps(config, sort_keys=True), config)
+    return list(configs.values())
+
+
+def thread_budget(workers, threads=None):
+    """Threads of each of workers concurrent trials, sharing the CPUs"""
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+    return threads
+
+
+class Registry():
+    """
+    Registry of sweep trials in an sqlite database. Every trial is a row
+    holding its hyperparameters as columns, its status, the final and
+    best training loss, its wall time and throughput, so sweeps can be
+    compared with SQL or with query().
+    """
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.execute(SCHEMA)
+
+    def __repr__(self):
+        return f"<Registry:{self.path}>"
+
+    def connect(self):
+        return closing(sqlite3.connect(self.path, timeout=60))
+
+    def execute(self, sql, args=()):
+        with self.connect() as db:
+            with db:
+                return db.execute(sql, args).lastrowid
+
+    def add(self, sweep, model_type, params, dataset=None):
+        """Register a pending trial, returning its trial ID"""
+        return self.execute(
+            'INSERT INTO trials (sweep, model_type, dataset, inner_dim, lr, '
+            'beta_1, batch_size, dropout_rate, epochs, params, status, '
+            'created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                sweep, model_type, dataset,
+                *(params.get(name) for name in SEARCH_SPACE),
+                params.get('epochs'), json.dumps(params, sort_keys=True),
+                'pending', time.time()
+            )
+        )
+
+    def update(self, trial, **fields):
+        columns = ', '.join(f'{column} = ?' for column in fields)
+        self.execute(
+            f'UPDATE trials SET {columns} WHERE trial = ?',
+            (*fields.values(), trial)
+        )
+
+    def done(self, sweep, model_type, dataset):
+        """Params of the trials of a sweep that finished on a dataset"""
+        with self.connect() as db:
+            rows = db.execute(
+                'SELECT params FROM trials WHERE sweep = ? AND '
+                'model_type = ? AND dataset = ? AND status = ?',
+                (sweep, model_type, dataset, 'done')
+            ).fetchall()
+        return set(row[0] for row in rows)
+
+    def query(self, where='1', args=()):
+        """Trials matching an SQL condition as a DataFrame, best first"""
+        with self.connect() as db:
+            return pd.read_sql_query(
+                f'SELECT * FROM trials WHERE {where} '
+                'ORDER BY final_loss IS NULL, final_loss, trial',
+                db, params=args
+            )
+
+
+def run_trial(trial, model_type, params, storepath, threads):
+    """
+    Train one configuration on the patch store at storepath, mapped
+    read-only so that concurrent trials share its pages. Runs with a
+    fresh TensorFlow session limited to threads and reports back a
+    result record.
+    """
+    import tensorflow as tf
+    from keras import backend as K
+    from . import models
+    from .callbacks import throughput_report
+
+    K.clear_session()
+    K.set_session(tf.Session(config=tf.ConfigProto(
+        intra_op_parallelism_threads=threads,
+        inter_op_parallelism_threads=min(threads, 2)
+    )))
+    patches_data, _ = PatchStore(storepath).open()
+    start = time.time()
+    result = {'trial': trial, 'ok': True, 'error': None, 'name': None}
+    try:
+        Model = getattr(models, model_type)
+        m = Model(
+            inner_dim=params['inner_dim'],
+            dropout_rate=params['dropout_rate']
+        )
+        # The trial names the model, its logs and its saved file
+        history = m.train_on_data(patches_data, dict(params, trial=trial))
+        m.save()
+        losses = history.history['loss']
+        epochs = throughput_report(
+            f'./tensorboardlogs/{m.name}/throughput.csv'
+        )
+        result.update({
+            'name': m.name,
+            'final_loss': float(losses[-1]),
+            'best_loss': float(np.min(losses)),
+            'epochs_run': len(losses),
+            'samples_per_second': float(
+                epochs['samples_per_second'].mean()
+            ),
+        })
+    except Exception as e:
+        result['ok'] = False
+        result['error'] = repr(e)
+    result['seconds'] = time.time() - start
+    K.clear_session()
+    return result
+
+
+def run_sweep(sweep, model_type, configs, storepath, patch_size, epochs,
+              workers=1, threads=None, registry=None):
+    """
+    Train every configuration on the patch store at storepath across a
+    pool of workers processes, each limited to its share of the CPUs,
+    recording every trial in the registry as it finishes. Trials of the
+    sweep already done on the same store are skipped, so an interrupted
+    sweep resumes where it stopped. Returns the trials of the sweep.
+    """
+    registry = registry or Registry()
+    threads = thread_budget(workers, threads)
+    # Skips trials already done and configurations given more than once
+    seen = registry.done(sweep, model_type, storepath)
+    tasks = []
+    for config in configs:
+        params = dict(config, patch_size=patch_size, epochs=epochs)
+        fingerprint = json.dumps(params, sort_keys=True)
+        if fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        trial = registry.add(sweep, model_type, params, storepath)
+        tasks.append((trial, model_type, params, storepath, threads))
+    logger.debug(
+        f'Running {len(tasks)} trials of {sweep} ({len(configs)} configs) '
+        f'with {workers} workers of {threads} threads'
+    )
+
+    def record(args, result):
+        result = dict(result)
+        ok = result.pop('ok')
+        result.pop('trial', None)
+        registry.update(
+            args[0], status='done' if ok else 'failed', threads=threads,
+            finished=time.time(), **result
+        )
+
+    # Workers inherit these and read them when they import TensorFlow
+    os.environ.update((name, str(threads)) for name in THREAD_VARIABLES)
+    run_pool(
+        run_trial, tasks, workers, key='trial', check=False, callback=record
+    )
+    return registry.query('sweep = ?', (sweep,))